@@ -17,7 +17,6 @@
 
 
 from __future__ import absolute_import, division, print_function
-from copy import deepcopy
 from pathlib import Path
 
 __version__ = "0.9.53"
@@ -28,6 +27,7 @@ import numpy as np
 import enum
 import inspect
 import sys
+import threading
 import time
 import datetime
 import os
@@ -38,8 +38,11 @@ from contextlib import contextmanager
 
 sys.path.append(r"G:\{ENG}\Home Folders\Testing\BrendanSloan\996.Software" +
                 r"\04.Python\pyOCRtools\pyocrtools")
-from image_acquisition import AcquireImage
+from image_acquisition import AcquireImage, pil_to_bgr
 from field_manager import FieldManager
+from field_session import FieldSession
+from frame_memo import FrameMemo
+from image_manipulation import adaptive_scale, text_bounding_box
 
 
 class PyAutoGUIException(Exception):
@@ -1507,7 +1510,35 @@ class TextGranularityEnum(enum.Enum):
     PARAGRAPH = 3
 
 
-def getText(BoundBox=None):
+# Last string read per BoundBox, so polling an unchanged region skips the OCR
+_TEXT_MEMO = FrameMemo()
+
+# FieldManagers set up for the field file, shared by getText callers
+_TEXT_SESSION = None
+_TEXT_SESSION_LOCK = threading.Lock()
+
+
+def _textSession():
+    """
+    The FieldSession of getText, created on first use
+
+    Returns
+    -------
+    <FieldSession>
+
+    """
+    global _TEXT_SESSION
+    with _TEXT_SESSION_LOCK:
+        if _TEXT_SESSION is None:
+            path_to_field_manager = \
+                Path(inspect.getfile(FieldManager)).parent
+            _TEXT_SESSION = FieldSession(
+                **{"field_file": str(path_to_field_manager /
+                                     "field_file.json5")})
+    return _TEXT_SESSION
+
+
+def getText(BoundBox=None, reuseUnchanged=True, changeTolerance=0):
     """
     Read the text from screen
 
@@ -1518,6 +1549,10 @@ def getText(BoundBox=None):
     ------
     BoundBox = (left,top, width, height)  integer tuple for bounding box of
     screengrab
+    reuseUnchanged = return the previous string for this BoundBox, without
+    running the OCR again, when the screengrab has not changed since
+    changeTolerance = mean absolute difference in grey levels up to which the
+    screengrab is unchanged, 0 requires it to be identical
 
     Returns
     -------
@@ -1529,27 +1564,87 @@ def getText(BoundBox=None):
     acquire_Image.screen_shot()
     img = acquire_Image.return_data("cv_image")
 
-    path_to_field_manager = Path(inspect.getfile(FieldManager)).parent
-    params = {"field_file": str(path_to_field_manager / "field_file.json5"),
-              "raw_image": img,
-              }
-    # Trying to instantiate then run off the instantiation handle seems to
-    # induce a problem with the inspect module for getting the path above
-    final_string = FieldManager(**params).return_data("final_string")
+    return _readText(img, BoundBox, reuseUnchanged, changeTolerance)
+
+
+def getTexts(BoundBoxes, reuseUnchanged=True, changeTolerance=0):
+    """
+    Read the text from several regions of the screen, from one screengrab
+
+    The screengrab covers the union of the regions, each is then read from a
+    view into it, so N regions cost a single capture
+
+    Params
+    ------
+    BoundBoxes = list of (left,top, width, height) integer tuples for the
+    bounding boxes to read
+    reuseUnchanged, changeTolerance = as getText, per BoundBox
+
+    Returns
+    -------
+    <list> of <string> per BoundBox
+
+    """
+    params = {"BoundBoxes": BoundBoxes}
+    acquire_Image = AcquireImage(**params)
+    images = acquire_Image.screen_shot_regions()
+    if images is None:
+        return [None] * len(BoundBoxes)
+
+    return [_readText(img, BoundBox, reuseUnchanged, changeTolerance)
+            for img, BoundBox in zip(images, BoundBoxes)]
+
+
+def _readText(img, BoundBox, reuseUnchanged, changeTolerance):
+    """
+    Walk a screengrab through the field file, unless it is unchanged
+
+    Params
+    ------
+    img = openCV image of the BoundBox
+    BoundBox, reuseUnchanged, changeTolerance = as getText
+
+    Returns
+    -------
+    <string>
+
+    """
+    session = _textSession()
+
+    # The field file's modification time keys out results read with an
+    # earlier version of it
+    memoKey = (tuple(BoundBox) if BoundBox else None, session.field_file,
+               session.field_mtime())
+    if reuseUnchanged:
+        found, final_string = _TEXT_MEMO.lookup(memoKey, img,
+                                                changeTolerance)
+        if found:
+            return final_string
+
+    final_string = session.read(img)[0]
+
+    if reuseUnchanged:
+        _TEXT_MEMO.store(memoKey, img, final_string, changeTolerance)
 
     return final_string
 
 
-def getTextBoxes(granularity=TextGranularityEnum.PARAGRAPH, BoundBox=None):
+def getTextBoxes(granularity=TextGranularityEnum.PARAGRAPH, BoundBox=None,
+                 cropText=False, adaptiveScale=False):
     """Determines bounding boxes of text on screen.
     Uses pytesseract (and, implicitly, Google's Tesseract OCR engine); will not
     function if these libraries are not available.
     Args:
         BoundBox = (left,top, width, height)  integer tuple for bounding box of
         screengrab
+        cropText = crop the screengrab to the region containing text before it
+        is upscaled for tesseract. The whole screengrab is used if no text is
+        found (default False)
+        adaptiveScale = upscale by a factor adapted to the text size, rather
+        than the fixed 4x (default False)
 
     Returns:
-        a list of `_BoundingBox`es
+        a list of `_BoundingBox`es, in screen coordinates
     """
     try:
         import pytesseract
@@ -1563,23 +1658,36 @@ def getTextBoxes(granularity=TextGranularityEnum.PARAGRAPH, BoundBox=None):
     # -------------------------------------------------------------------------
     # Can use a few approaches to improve tesseract performance
 
-    img0 = np.asarray(screen, dtype="uint8")  # Convert screen shot from image
-    # Note, the above will be in RGB format, whereas openCV works in BGR format
-
-    # Convert to BGR as per below
-    img = deepcopy(img0)
-    img[0,:,0] = img0[0,:,2]
-    img[0,:,2] = img0[0,:,0]
-    img[1,:,0] = img0[1,:,2]
-    img[1,:,2] = img0[1,:,0]
+    # The screen shot is RGB, whereas openCV works in BGR format
+    img = pil_to_bgr(screen)
 
     # Then attempt some openCV massaging of the screenshot to make tesseract's
     # task easier
     gry = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     thr = cv2.threshold(gry, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-    scale = cv2.resize(thr, None, fx=4, fy=4, interpolation=cv2.INTER_CUBIC)
+
+    # Only upscale the region holding text, the margins would just cost
+    # resize and tesseract time
+    cropX, cropY = 0, 0
+    region = text_bounding_box(gry) if cropText else None
+    if region is not None:
+        cropX, cropY, cropW, cropH = region
+        thr = thr[cropY:cropY+cropH, cropX:cropX+cropW]
+
+    # Optionally upscale only as far as tesseract needs for the size of the
+    # text, large fonts are not upscaled at all
+    factor = adaptive_scale(thr) if adaptiveScale else 4
+    if factor == 1:
+        scale = thr
+    else:
+        scale = cv2.resize(thr, None, fx=factor, fy=factor,
+                           interpolation=cv2.INTER_CUBIC)
     data = pytesseract.image_to_data(scale)
 
+    # Map the boxes from the upscaled crop back to screen coordinates
+    originX = cropX + (BoundBox[0] if BoundBox else 0)
+    originY = cropY + (BoundBox[1] if BoundBox else 0)
+
     # -------------------------------------------------------------------------
 
     #data = pytesseract.image_to_data(screen)
@@ -1591,6 +1699,10 @@ def getTextBoxes(granularity=TextGranularityEnum.PARAGRAPH, BoundBox=None):
         if not line:
             continue
         box = _BoundingBox.parseFrom(line)
+        box = box._replace(left=int(box.left / factor) + originX,
+                           top=int(box.top / factor) + originY,
+                           width=int(round(box.width / factor)),
+                           height=int(round(box.height / factor)))
 
         key = [box.par_num]
         if granularity in {TextGranularityEnum.LINE, TextGranularityEnum.WORD}:
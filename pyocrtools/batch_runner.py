@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+Batch processing of image files through FieldManager, with checkpointing
+
+Every finished image is appended to a JSONL journal as soon as its result
+comes back, and flushed to disk. On restart the journal is read back, finished
+images are skipped and everything else (including those in flight when the
+previous run died) is queued again. As each worker holds a single image at a
+time, at most one image per worker is reworked.
+
+Each worker, and the in process loop, sets up a single FieldManager and walks
+every image it's handed through it, reading the field file once.
+"""
+
+from pathlib import Path
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+
+# My py
+from image_acquisition import AcquireImage
+from field_manager import FieldManager
+from image_loader import ImageLoader, IMAGE_SUFFIXES
+from json5_reader import Json5Reader
+from plan_compiler import PlanCompiler
+
+
+# Per worker FieldManager, set up by _init_worker
+_worker_manager = None
+
+
+# -----------------------------------------------------------------------------
+def _field_manager(field_kwargs):
+    """
+    Set up a FieldManager to walk many images through
+
+    Params
+    ------
+    field_kwargs : <dict> kwargs for FieldManager
+
+    Returns
+    -------
+    <FieldManager>
+
+    """
+    params = dict(field_kwargs)
+    params.update({"walk": False,
+                   "cache_paths": True,
+                   })
+    return FieldManager(**params)
+
+
+# -----------------------------------------------------------------------------
+def _init_worker(field_kwargs):
+    """
+    Pool initializer, setting up the worker's FieldManager
+
+    Params
+    ------
+    field_kwargs : <dict> kwargs for FieldManager
+
+    Returns
+    -------
+    None
+
+    """
+    global _worker_manager
+    _worker_manager = _field_manager(field_kwargs)
+
+
+# -----------------------------------------------------------------------------
+def _process_image(task, img=None, loaded=False, manager=None):
+    """
+    Walk a single image file through the fields, within a worker
+
+    Params
+    ------
+    task : <tuple> of (image file, decode hints or None)
+    img : <image> Optional image already read from the file
+    loaded : <bool> Reading the file has been attempted already, e.g. by
+        ImageLoader, so a None img is a failure rather than read here
+    manager : <FieldManager> Optional, otherwise the worker's
+
+    Returns
+    -------
+    <dict> journal record for the image
+
+    """
+    image_file, decode_hints = task
+    if manager is None:
+        manager = _worker_manager
+    try:
+        if img is None and not loaded:
+            img = AcquireImage(**{"ImageFile": image_file,
+                                  "DecodeHints": decode_hints}).open_image()
+        if img is None:
+            raise ValueError("Unable to open image")
+        for _ in manager.field_walker(**{"raw_image": img}):
+            pass
+        score = manager.return_data("final_score")
+        record = {"image": image_file,
+                  "status": "done",
+                  "string": manager.return_data("final_string"),
+                  "score": None if score is None else float(score),
+                  }
+    except Exception as err:
+        record = {"image": image_file,
+                  "status": "failed",
+                  "error": repr(err),
+                  }
+    finally:
+        # The image needn't outlive its walk
+        manager.raw_image = manager.image = None
+    return record
+
+
+# -----------------------------------------------------------------------------
+class BatchRunner:
+    """
+    Class for running a batch of image files with a resumable journal
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>
+            image_files : <list> of image file paths, or
+            image_dir : <str> directory of images to process
+            journal : <str> full path to the JSONL journal file
+            field_file : <str> full path to the field file
+            field_kwargs : <dict> Optional further kwargs for FieldManager
+            n_workers : <int> Number of worker processes, 1 runs in process
+            retry_failed : <bool> Re-queue images journalled as failed
+            reduced_decode : <bool> Decode the images as greyscale or at a
+                reduced resolution where the field plan allows, via
+                PlanCompiler.decode_hints. Not bit-exact against a full
+                decode (default False)
+
+        Returns
+        -------
+        None
+
+        """
+        self.image_files = None
+        self.image_dir = None
+        self.field_kwargs = {}
+        self.n_workers = mp.cpu_count()
+        self.retry_failed = False
+        self.reduced_decode = False
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+        if self.image_files is None and self.image_dir:
+            self.image_files = [
+                str(f) for f in sorted(Path(self.image_dir).iterdir())
+                if f.suffix.lower() in IMAGE_SUFFIXES]
+
+    # -------------------------------------------------------------------------
+    def journal_reader(self):
+        """
+        Read back the journal of a previous run
+
+        A partially written final line (the run died mid-write) is ignored
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict> of image file to its journal record
+
+        """
+        records = {}
+        if not Path(self.journal).exists():
+            return records
+
+        with open(self.journal, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record["image"]] = record
+        return records
+
+    # -------------------------------------------------------------------------
+    def journal_repair(self):
+        """
+        Truncate a partially written final line from the journal, so the
+        records appended by this run start on a line of their own
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <int> number of bytes truncated
+
+        """
+        if not Path(self.journal).exists():
+            return 0
+
+        with open(self.journal, "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            # Scan back from the end for the last newline
+            while end > 0:
+                start = max(end - 4096, 0)
+                f.seek(start)
+                chunk = f.read(end - start)
+                i_newline = chunk.rfind(b"\n")
+                if i_newline >= 0:
+                    end = start + i_newline + 1
+                    break
+                end = start
+            if end < size:
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+                print("Truncated a partial record of " + str(size - end) +
+                      " bytes from journal: " + str(self.journal))
+        return size - end
+
+    # -------------------------------------------------------------------------
+    def pending_images(self):
+        """
+        Gather the images still to process, skipping those journalled
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <list> of image files
+
+        """
+        records = self.journal_reader()
+        pending = []
+        for image_file in self.image_files:
+            record = records.get(image_file)
+            if record is None:
+                pending.append(image_file)
+            elif record["status"] == "failed" and self.retry_failed:
+                pending.append(image_file)
+        print(str(len(self.image_files) - len(pending)) + " of " +
+              str(len(self.image_files)) + " images already journalled")
+        return pending
+
+    # -------------------------------------------------------------------------
+    def run(self):
+        """
+        Process all pending images, journalling each as it finishes
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <int> number of images processed in this run
+
+        """
+        field_kwargs = dict(self.field_kwargs)
+        field_kwargs["field_file"] = self.field_file
+        if self.n_workers > 1:
+            # Each worker's walk takes only its share of the cores
+            field_kwargs.setdefault("outer_workers", self.n_workers)
+
+        decode_hints = None
+        if self.reduced_decode:
+            fields = Json5Reader(**{"filePath": self.field_file}).read_json()
+            if fields:
+                compiler = PlanCompiler()
+                decode_hints = compiler.decode_hints(fields)
+                field_kwargs["fields"] = \
+                    compiler.apply_decode_hints(fields, decode_hints)
+                print("Decoding with " + str(decode_hints))
+
+        tasks = [(image_file, decode_hints)
+                 for image_file in self.pending_images()]
+
+        n_done = 0
+        self.journal_repair()
+        with open(self.journal, "a") as journal:
+            if self.n_workers > 1:
+                with mp.Pool(processes=self.n_workers,
+                             initializer=_init_worker,
+                             initargs=(field_kwargs,)) as pool:
+                    # chunksize of 1 keeps a single image per worker in
+                    # flight, bounding the rework after a crash
+                    for record in pool.imap_unordered(_process_image, tasks,
+                                                      chunksize=1):
+                        self.journal_writer(journal, record)
+                        n_done += 1
+            else:
+                # Decode the next images while this one is walked
+                params = {"image_files": [task[0] for task in tasks]}
+                if decode_hints:
+                    params["imread_flags"] = decode_hints["imread_flags"]
+                loader = ImageLoader(**params)
+                manager = _field_manager(field_kwargs)
+                for task, (_, img) in zip(tasks, loader):
+                    self.journal_writer(
+                        journal, _process_image(task, img, True, manager))
+                    n_done += 1
+        return n_done
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def journal_writer(journal, record):
+        """
+        Durably append a record to the journal
+
+        Params
+        ------
+        journal : <file> journal opened for appending
+        record : <dict>
+
+        Returns
+        -------
+        None
+
+        """
+        journal.write(json.dumps(record) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    # -------------------------------------------------------------------------
+    def results(self):
+        """
+        Gather the finished results from the journal
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict> of image file to final string
+
+        """
+        return {image_file: record["string"]
+                for image_file, record in self.journal_reader().items()
+                if record["status"] == "done"}
+
+    # -------------------------------------------------------------------------
+    def return_data(self, attr):
+        """
+        Return the data 'attr' within the class
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        if hasattr(self, attr):
+            rtn = getattr(self, attr)
+        else:
+            print("Cannot find attribute: " + str(attr) + " to return")
+            rtn = None
+        return rtn
+
+
+# -----------------------------------------------------------------------------
+# ---- main
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Resumable batch OCR of a directory of images")
+    parser.add_argument("image_dir")
+    parser.add_argument("journal")
+    parser.add_argument("--field_file",
+                        default=str(Path(__file__).parent /
+                                    "field_file.json5"))
+    parser.add_argument("--n_workers", type=int, default=mp.cpu_count())
+    parser.add_argument("--retry_failed", action="store_true")
+    parser.add_argument("--reduced_decode", action="store_true")
+    args = parser.parse_args()
+
+    handle = BatchRunner(**vars(args))
+    n_done = handle.run()
+    print("Processed " + str(n_done) + " images this run")
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of preallocated image buffers, keyed by shape and dtype
+
+ImageManipulation operators write into buffers from the pool via OpenCV's
+dst= arguments rather than allocating a fresh array per call, and FieldManager
+hands buffers back as intermediate images are superseded or candidate paths
+are pruned at a gate.
+"""
+
+from collections import defaultdict
+
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+# -----------------------------------------------------------------------------
+def peak_rss():
+    """
+    Peak resident set size of this process
+
+    Params
+    ------
+    None
+
+    Returns
+    -------
+    <int> bytes, or None where it cannot be determined
+
+    """
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return rss if sys.platform == "darwin" else rss * 1024
+    except ImportError:
+        pass
+
+    try:
+        import psutil  # Windows has no resource module
+        return psutil.Process().memory_info().peak_wset
+    except Exception:
+        return None
+
+
+# -----------------------------------------------------------------------------
+class BufferPool:
+    """
+    Class pooling numpy buffers by shape and dtype
+
+    Thread safe, so may be shared by the MT path controller. Only buffers
+    handed out by the pool are ever taken back, releasing any other array is
+    a no-op, so callers needn't track where an image came from
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>
+            max_pooled_bytes : <int> Optional cap on bytes held free in the
+                pool, released buffers beyond this are dropped
+
+        Returns
+        -------
+        None
+
+        """
+        self.max_pooled_bytes = None
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+        self._lock = threading.Lock()
+        self._free = defaultdict(list)
+        self._outstanding = {}
+        self.allocations = 0
+        self.reuses = 0
+        self.releases = 0
+        self.pooled_bytes = 0
+        self.outstanding_bytes = 0
+        self.peak_bytes = 0
+
+    # -------------------------------------------------------------------------
+    def acquire(self, shape, dtype):
+        """
+        Hand out a buffer, reusing a pooled one where available
+
+        Contents are undefined, the caller is expected to overwrite them
+
+        Params
+        ------
+        shape : <tuple>
+        dtype : numpy dtype
+
+        Returns
+        -------
+        <numpy array>
+
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            if self._free[key]:
+                buf = self._free[key].pop()
+                self.pooled_bytes -= buf.nbytes
+                self.reuses += 1
+            else:
+                buf = np.empty(shape, dtype)
+                self.allocations += 1
+            self._outstanding[id(buf)] = buf
+            self.outstanding_bytes += buf.nbytes
+            self.peak_bytes = max(self.peak_bytes,
+                                  self.outstanding_bytes + self.pooled_bytes)
+        return buf
+
+    # -------------------------------------------------------------------------
+    def release(self, buf):
+        """
+        Return a buffer to the pool
+
+        Params
+        ------
+        buf : <numpy array> ignored unless handed out by this pool
+
+        Returns
+        -------
+        None
+
+        """
+        if buf is None:
+            return
+        with self._lock:
+            if self._outstanding.pop(id(buf), None) is None:
+                return
+            self.outstanding_bytes -= buf.nbytes
+            self.releases += 1
+            if self.max_pooled_bytes is not None and \
+                    self.pooled_bytes + buf.nbytes > self.max_pooled_bytes:
+                return  # Let it go to the garbage collector
+            self._free[(buf.shape, buf.dtype.str)].append(buf)
+            self.pooled_bytes += buf.nbytes
+
+    # -------------------------------------------------------------------------
+    def detach(self, buf):
+        """
+        Hand ownership of a buffer to the caller, it will never be recycled
+
+        For images retained beyond the walk, e.g. by a cache
+
+        Params
+        ------
+        buf : <numpy array>
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            if self._outstanding.pop(id(buf), None) is not None:
+                self.outstanding_bytes -= buf.nbytes
+
+    # -------------------------------------------------------------------------
+    def clear(self):
+        """
+        Drop all free buffers held by the pool
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            self._free.clear()
+            self.pooled_bytes = 0
+
+    # -------------------------------------------------------------------------
+    def stats(self):
+        """
+        Allocation and memory statistics
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict>
+
+        """
+        with self._lock:
+            return {"allocations": self.allocations,
+                    "reuses": self.reuses,
+                    "releases": self.releases,
+                    "outstanding_bytes": self.outstanding_bytes,
+                    "pooled_bytes": self.pooled_bytes,
+                    "peak_bytes": self.peak_bytes,
+                    "peak_rss": peak_rss(),
+                    }
+
+    # -------------------------------------------------------------------------
+    def __getstate__(self):
+        """
+        Pickle as an empty pool, buffers and the lock stay in this process
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict>
+
+        """
+        return {"max_pooled_bytes": self.max_pooled_bytes}
+
+    # -------------------------------------------------------------------------
+    def __setstate__(self, state):
+        """
+        Rebuild an empty pool in the receiving process
+
+        Params
+        ------
+        state : <dict>
+
+        Returns
+        -------
+        None
+
+        """
+        self.__init__(**state)
+
+
+# -----------------------------------------------------------------------------
+# ---- main
+if __name__ == "__main__":
+    # Benchmark a typical path on a 4K capture, with the pool unless
+    # "nopool" is given. Run each mode in its own process to compare peak RSS
+    from image_manipulation import ImageManipulation
+
+    use_pool = "nopool" not in sys.argv[1:]
+    pool = BufferPool() if use_pool else None
+
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (2160, 3840, 3), dtype=np.uint8)
+    chain = [("threshold", {"Binary_OTSU": "True", "MedianBlur": "3"}),
+             ("invert", {}),
+             ("resize", {"fx": 2, "fy": 2}),
+             ("dilate", {}),
+             ]
+
+    manip = ImageManipulation(**{"pool": pool})
+    n_calls = 0
+    start = time.perf_counter()
+    for _ in range(20):
+        out = img
+        for foo, params in chain:
+            new = getattr(manip, foo)(**{"img": out, **params})
+            n_calls += 1
+            if use_pool and out is not img:
+                pool.release(out)
+            out = new
+        if use_pool:
+            pool.release(out)
+    print(("pool" if use_pool else "no pool") + ": " +
+          str(round(time.perf_counter() - start, 3)) + " s, peak RSS " +
+          str(peak_rss()))
+    if use_pool:
+        print(pool.stats())
+    else:
+        print({"allocations": n_calls})
@@ -17,6 +17,7 @@ import pytesseract as pyt
 
 from image_acquisition import AcquireImage
 from json5_reader import Json5Reader
+from trace_events import trace_span
 
 class CaptureOCR:
     """
@@ -86,7 +87,11 @@ class CaptureOCR:
 
 
         """
-        img_rgb = cv2.cvtColor(self.cv2Image, cv2.COLOR_BGR2RGB)
+        if self.cv2Image.ndim == 3:
+            img_rgb = cv2.cvtColor(self.cv2Image, cv2.COLOR_BGR2RGB)
+        else:
+            # Greyscale/thresholded images need no channel swap
+            img_rgb = self.cv2Image
 
         param_headers = ["lang", "config", "nice",
                          "timeout", "pandas_config"]
@@ -102,14 +107,19 @@ class CaptureOCR:
             sub_kwargs = {}
             for k in are_configs:
                 sub_kwargs[k] = kwargs[k]
-            self.ocr = pyt.image_to_data(
-                img_rgb, **sub_kwargs, output_type="data.frame")
-            self.ocr_string = pyt.image_to_string(
-                img_rgb, **sub_kwargs).strip()  # Can try to clean a bit
+            with trace_span("image_to_data", "ocr", shape=img_rgb.shape):
+                self.ocr = pyt.image_to_data(
+                    img_rgb, **sub_kwargs, output_type="data.frame")
+            with trace_span("image_to_string", "ocr", shape=img_rgb.shape):
+                self.ocr_string = pyt.image_to_string(
+                    img_rgb, **sub_kwargs).strip()  # Can try to clean a bit
         else:
-            self.ocr = pyt.image_to_data(img_rgb, output_type="data.frame")
-            self.ocr_string = pyt.image_to_string(
-                img_rgb).strip()  # Can try to clean a bit
+            with trace_span("image_to_data", "ocr", shape=img_rgb.shape):
+                self.ocr = pyt.image_to_data(img_rgb,
+                                             output_type="data.frame")
+            with trace_span("image_to_string", "ocr", shape=img_rgb.shape):
+                self.ocr_string = pyt.image_to_string(
+                    img_rgb).strip()  # Can try to clean a bit
 
         self.performance_manager()
 
@@ -221,7 +231,11 @@ class CaptureOCR:
 
         # Do the inversion and factor by 100. A score of 100 would then mean
         # 100% of our characters are conventional alphanumerics
-        final_score = 100*(len(ocr_string) - running_total)/len(ocr_string)
+        if ocr_string:
+            final_score = \
+                100*(len(ocr_string) - running_total)/len(ocr_string)
+        else:
+            final_score = 0  # Nothing read, nothing to rank favourably
         self.score_irregular_chars = final_score
 
     # -------------------------------------------------------------------------
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Coherent thread limits for OpenCV, tesseract and the path controllers
+
+Left alone, every level of parallelism sizes itself to the whole machine:
+the MT/SMP controllers run a worker per core, OpenCV runs a thread pool per
+core behind each worker, ImageManipulation tiles across a thread per core and
+each tesseract child spins up an OpenMP thread per core. On an 8 core box
+running 8 paths that is well over 100 runnable threads, and throughput drops.
+
+The governor splits the cores between the path workers, so each worker gets
+cores // workers threads for OpenCV (cv2.setNumThreads), tiling
+(tile_workers) and tesseract (OMP_THREAD_LIMIT, read by each child as it
+starts). Worker counts above the core count are capped. Processes sharing the
+box with the session, e.g. BatchRunner workers, are given as outer_workers.
+
+The OpenCV thread count and OMP_THREAD_LIMIT are process wide, so governors
+applied concurrently (e.g. walks on the threads of a FieldSession) are
+reference counted: the settings in place before the first are saved, the
+tightest limits of those applied are in force, and the saved settings are
+restored when the last is.
+"""
+
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+
+import cv2
+
+
+OMP_ENV = "OMP_THREAD_LIMIT"
+
+# Governors applied within this process, by id, of [count, limits], and the
+# settings in place before the first of them
+_applied = {}
+_applied_saved = None
+_applied_lock = threading.Lock()
+
+
+# -----------------------------------------------------------------------------
+def available_cores():
+    """
+    Number of cores this process may run on, honouring any affinity mask
+
+    Params
+    ------
+    None
+
+    Returns
+    -------
+    <int>
+
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, mp.cpu_count())
+
+
+# -----------------------------------------------------------------------------
+def apply_thread_limits(cv2_threads, omp_thread_limit):
+    """
+    Set the OpenCV thread count and the tesseract OpenMP limit
+
+    Module level so it may be given as a process pool initializer, spawned
+    workers don't inherit the OpenCV setting
+
+    Params
+    ------
+    cv2_threads : <int>
+    omp_thread_limit : <int>
+
+    Returns
+    -------
+    None
+
+    """
+    cv2.setNumThreads(int(cv2_threads))
+    os.environ[OMP_ENV] = str(int(omp_thread_limit))
+
+
+# -----------------------------------------------------------------------------
+def _apply_tightest():
+    """
+    Set the tightest limits of the governors applied, under _applied_lock
+
+    Params
+    ------
+    None
+
+    Returns
+    -------
+    None
+
+    """
+    limits = [entry[1] for entry in _applied.values()]
+    apply_thread_limits(min(lim["cv2_threads"] for lim in limits),
+                        min(lim["omp_thread_limit"] for lim in limits))
+
+
+# -----------------------------------------------------------------------------
+class ConcurrencyGovernor:
+    """
+    Class sizing the thread pools of a session from its path parallelism
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>
+            controller : <str> Path controller, "ST", "MT" or "SMP"
+            n_workers : <int> Workers requested of the MT/SMP controllers
+            outer_workers : <int> Processes sharing the cores with this
+                session, e.g. BatchRunner workers (default 1)
+            cores : <int> Optional core count, by default those available
+            omp_thread_limit : <int> Optional tesseract thread limit,
+                overriding the share of the cores
+
+        Returns
+        -------
+        None
+
+        """
+        self.controller = "ST"
+        self.n_workers = mp.cpu_count()
+        self.outer_workers = 1
+        self.cores = None
+        self.omp_thread_limit = None
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+        if self.cores is None:
+            self.cores = available_cores()
+
+    # -------------------------------------------------------------------------
+    def plan(self):
+        """
+        Thread limits for the session
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict> of
+            cores : <int> cores left to the session
+            n_workers : <int> path workers, capped at the cores
+            cv2_threads : <int> OpenCV threads
+            tile_workers : <int> ImageManipulation tiling threads
+            omp_thread_limit : <int> tesseract OpenMP threads
+
+        """
+        cores = max(1, self.cores // max(1, int(self.outer_workers)))
+        n_workers = max(1, min(int(self.n_workers), cores))
+        parallel = 1 if self.controller == "ST" else n_workers
+        share = max(1, cores // parallel)
+
+        omp_thread_limit = share if self.omp_thread_limit is None \
+            else int(self.omp_thread_limit)
+        return {"cores": cores,
+                "n_workers": n_workers,
+                "cv2_threads": share,
+                "tile_workers": share,
+                "omp_thread_limit": omp_thread_limit,
+                }
+
+    # -------------------------------------------------------------------------
+    def apply(self):
+        """
+        Apply the limits to this process, saving the previous settings if no
+        other governor is applied. Each apply is paired with a restore
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict> as plan
+
+        """
+        global _applied_saved
+        limits = self.plan()
+        with _applied_lock:
+            if not _applied:
+                _applied_saved = (cv2.getNumThreads(),
+                                  os.environ.get(OMP_ENV))
+            entry = _applied.setdefault(id(self), [0, limits])
+            entry[0] += 1
+            entry[1] = limits
+            _apply_tightest()
+        return limits
+
+    # -------------------------------------------------------------------------
+    def restore(self):
+        """
+        Undo an apply, restoring the settings in place before the first
+        governor was applied once none remain
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        global _applied_saved
+        with _applied_lock:
+            entry = _applied.get(id(self))
+            if entry is None:
+                return
+            entry[0] -= 1
+            if entry[0] <= 0:
+                del _applied[id(self)]
+            if _applied:
+                _apply_tightest()
+                return
+
+            cv2_threads, omp_thread_limit = _applied_saved
+            cv2.setNumThreads(cv2_threads)
+            if omp_thread_limit is None:
+                os.environ.pop(OMP_ENV, None)
+            else:
+                os.environ[OMP_ENV] = omp_thread_limit
+            _applied_saved = None
+
+    # -------------------------------------------------------------------------
+    def worker_initializer(self):
+        """
+        Initializer and args applying the limits within pool processes
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict> of initializer and initargs, for multiprocessing.Pool
+
+        """
+        limits = self.plan()
+        return {"initializer": apply_thread_limits,
+                "initargs": (limits["cv2_threads"],
+                             limits["omp_thread_limit"]),
+                }
+
+    # -------------------------------------------------------------------------
+    def return_data(self, attr):
+        """
+        Return the data 'attr' within the class
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        if hasattr(self, attr):
+            rtn = getattr(self, attr)
+        else:
+            print("Cannot find attribute: " + str(attr) + " to return")
+            rtn = None
+        return rtn
+
+
+# -----------------------------------------------------------------------------
+# ---- main
+if __name__ == "__main__":
+    # Throughput curve of the MT controller's workload, a manipulation chain
+    # on a 1080p capture per path, against the worker count, with and without
+    # the governor. Pass "ocr" to include a tesseract call per path
+    from concurrent.futures import ThreadPoolExecutor
+
+    import numpy as np
+
+    from image_manipulation import ImageManipulation
+
+    with_ocr = "ocr" in sys.argv[1:]
+    if with_ocr:
+        import pytesseract as pyt
+
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (1080, 1920, 3), dtype=np.uint8)
+    chain = [("grey_blur_otsu", {"MedianBlur": "5"}),
+             ("resize", {"fx": 2, "fy": 2}),
+             ("dilate", {}),
+             ]
+    n_paths = 32
+    cores = available_cores()
+    default_threads = cv2.getNumThreads()
+
+    def run_path(manip):
+        out = img
+        for foo, params in chain:
+            out = getattr(manip, foo)(**{"img": out, **params})
+        if with_ocr:
+            pyt.image_to_string(out[:256, :1024])
+        return out
+
+    print(str(cores) + " cores available")
+    run_path(ImageManipulation())  # Warm up OpenCV's pools and IPP
+    for n_workers in sorted({1, 2, 4, 8, 2 * cores}):
+        for governed in (False, True):
+            params = {"controller": "MT", "n_workers": n_workers}
+            governor = ConcurrencyGovernor(**params)
+            if governed:
+                limits = governor.apply()
+                n_threads = limits["n_workers"]
+                manip = ImageManipulation(
+                    **{"tile_workers": limits["tile_workers"]})
+            else:
+                cv2.setNumThreads(default_threads)
+                n_threads = n_workers
+                manip = ImageManipulation()
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                list(pool.map(lambda _: run_path(manip), range(n_paths)))
+            elapsed = time.perf_counter() - start
+            governor.restore()
+
+            print(str(n_workers).rjust(3) + " workers, " +
+                  ("governed  " if governed else "ungoverned") + ": " +
+                  str(round(n_paths / elapsed, 2)) + " paths/s")
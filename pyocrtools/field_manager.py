@@ -6,17 +6,97 @@ Created on Thu Jun 30 09:54:52 2022
 
 """
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import inspect
+import time
 
 import multiprocessing as mp
 
 # My py
 from image_acquisition import AcquireImage
-from image_manipulation import ImageManipulation
+from image_manipulation import ImageManipulation, image_digest
 from capture_ocr import CaptureOCR
+from concurrency_governor import ConcurrencyGovernor
 from json5_reader import Json5Reader
+from operator_registry import REGISTRY
+from path_sweep import PathSweep
+from plan_compiler import PlanCompiler
+from trace_events import trace_span
+
+
+# Field files already warned about for abandoned paths, so the warning is
+# given once per field file rather than once per image
+_warned_field_files = set()
+
+
+# The FieldManager and gate image of an SMP worker, sent once per pool rather
+# than with every task
+_smp_manager = None
+_smp_image = None
+
+
+# -----------------------------------------------------------------------------
+def _init_smp_worker(manager, img, initializer=None, initargs=()):
+    """
+    Receive the FieldManager and the image entering the gate, within an SMP
+    worker
+
+    Params
+    ------
+    manager : <FieldManager> pickled without its images or paths
+    img : <image> image entering the gate
+    initializer : <callable> Optional further initializer, e.g. the
+        governor's thread limits
+    initargs : <tuple> args for initializer
+
+    Returns
+    -------
+    None
+
+    """
+    global _smp_manager, _smp_image
+    if initializer is not None:
+        initializer(*initargs)
+    _smp_manager = manager
+    _smp_image = img
+
+
+# -----------------------------------------------------------------------------
+def _smp_path_task(task):
+    """
+    Run a path on the gate image within an SMP worker
+
+    Params
+    ------
+    task : <tuple> of (path name, list of steps)
+
+    Returns
+    -------
+    <dict>
+
+    """
+    return _smp_manager.path_runner(**{"path": task[1],
+                                       "path_name": task[0],
+                                       "img": _smp_image})
+
+
+# -----------------------------------------------------------------------------
+def _smp_ocr_task(img):
+    """
+    OCR and score a path output within an SMP worker
+
+    Params
+    ------
+    img : <image>
+
+    Returns
+    -------
+    <dict>
+
+    """
+    return _smp_manager.ocr_runner(**{"img": img})
 
 
 # -----------------------------------------------------------------------------
@@ -39,21 +119,99 @@ class FieldManager:
         Params
         ------
         kwargs : <dict>
+            field_file : <str> full path to the field file
+            fields : <dict> Optional in-memory field plan, used instead of
+                reading field_file
+            raw_image : <image> openCV image to walk through the fields
+            controller : <str> Path controller to use, "ST" (default), "MT"
+                (threaded) or "SMP" (multiprocess)
+            n_workers : <int> Number of workers for the MT/SMP controllers
+            sweep_cap : <int> Optional cap on concrete swept paths per
+                field, larger sweeps are randomly sampled down to this
+            sweep_seed : <int> Optional seed for the sweep sampling
+            walk : <bool> Walk the fields on instantiation (default True).
+                Set False to drive the walk through field_walker instead
+            buffer_pool : <BufferPool> Optional pool for the manipulation
+                outputs, buffers are handed back as paths are pruned
+            compile_paths : <bool> Simplify paths and substitute fused
+                operators for common chains of steps via PlanCompiler
+                (default True), images are identical either way
+            approximate_paths : <bool> Also let PlanCompiler merge
+                consecutive resizes, which is not bit-exact (default False)
+            crop_paths : <bool> Crop to the text region before the first
+                upscale of each path (default False)
+            tile_threshold : <int> Optional pixel count from which the
+                manipulation filters are tiled across threads
+            tile_workers : <int> Optional thread count for tiling, 1 disables
+            image_cache : <ImageCache> Optional cache of intermediate images
+                by gate image and step prefix, e.g. image_cache.SHARED_CACHE
+                to share across all sessions in the process. Not used by the
+                SMP controller, whose workers can't share it
+            govern_threads : <bool> Size the OpenCV, tiling and tesseract
+                thread counts from the controller parallelism, capping
+                n_workers at the cores, via ConcurrencyGovernor (default
+                True). Applied for the duration of the walk
+            outer_workers : <int> Processes sharing the cores with this
+                session, e.g. BatchRunner workers (default 1)
+            cache_paths : <bool> Expand and compile the paths of each field
+                once, for instances walking many images (default False).
+                Sweeps are then materialised, and any sampling of them
+                fixed, at the first walk
+            verbose : <bool> Print the field being worked on and the savings
+                of each walk (default True)
 
         Returns
         -------
         None
 
         """
+        self.controller = "ST"
+        self.n_workers = mp.cpu_count()
+        self.sweep_cap = None
+        self.sweep_seed = None
+        self.ocr_calls_saved = 0
+        self.walk = True
+        self.raw_image = None
+        self.buffer_pool = None
+        self.compile_paths = True
+        self.approximate_paths = False
+        self.crop_paths = False
+        self.tile_threshold = None
+        self.tile_workers = None
+        self.image_cache = None
+        self.image_key = None
+        self.govern_threads = True
+        self.outer_workers = 1
+        self.cache_paths = False
+        self.verbose = True
+
         # This will set all entries within kwargs into the class variable space
         for key_val in kwargs.items():
             setattr(self, key_val[0], key_val[1])
 
         self.image = self.raw_image  # Just retain the raw_image incase
+        self.compiled_paths = {}
+        self.governor = None
+        if self.govern_threads:
+            self.governor = ConcurrencyGovernor(
+                **{"controller": self.controller,
+                   "n_workers": self.n_workers,
+                   "outer_workers": self.outer_workers})
+            limits = self.governor.plan()
+            self.n_workers = limits["n_workers"]
+            if self.tile_workers is None:
+                self.tile_workers = limits["tile_workers"]
+        self.plan_compiler = PlanCompiler(
+            **{"fuse": self.compile_paths,
+               "simplify": self.compile_paths,
+               "approximate": self.approximate_paths,
+               "crop_text": self.crop_paths})
 
         self.field_reader()
         self.list_manipulation_functions()
-        self.field_marshall()
+        self.field_validator()
+        if self.walk:
+            self.field_marshall()
 
     # -------------------------------------------------------------------------
     def field_marshall(self):
@@ -69,17 +227,90 @@ class FieldManager:
         None
 
         """
-        for field_name, field_data in self.fields.items():
-            print("Currently working on: " + field_name)
-            self.paths = field_data
-            field_results = self.path_controller_ST()
+        for _ in self.field_walker():
+            pass
 
-            # Update the control image to the best ranked
-            self.image = field_results[0]["img"]
+    # -------------------------------------------------------------------------
+    def field_walker(self, **kwargs):
+        """
+        Walk the fields, yielding the provisional result after each gate
 
-        # At the end, we should have a decent image and string
-        self.final_string = field_results[0]["string"]
-        self.final_score = field_results[0]["score"]
+        Stopping the iteration early (break, or close() on the generator)
+        aborts the remaining fields, final_string and final_score are left at
+        the provisional result of the last gate exited
+
+        Params
+        ------
+        kwargs : <dict>
+            raw_image : <image> Optional image to walk, otherwise the one
+                given at instantiation
+
+        Returns
+        -------
+        <generator> of <dict> per gate, of field name, ranked (path name,
+            score) tuples, current best string and score, and elapsed seconds
+
+        """
+        if "raw_image" in kwargs:
+            self.raw_image = kwargs["raw_image"]
+        self.image = self.raw_image
+
+        controllers = {"ST": self.path_controller_ST,
+                       "MT": self.path_controller_MT,
+                       "SMP": self.path_controller_SMP,
+                       }
+        if self.governor is not None:
+            self.governor.apply()
+        try:
+            self.final_string = None
+            self.final_score = None
+            # Savings are reported per walk
+            self.ocr_calls_saved = 0
+            self.plan_compiler.steps_eliminated = 0
+            start = time.perf_counter()
+            for field_name, field_data in self.fields.items():
+                if self.verbose:
+                    print("Currently working on: " + field_name)
+                self.paths = self.path_expander(field_data, field_name)
+                if self.image_cache is not None:
+                    self.image_key = image_digest(self.image)
+                with trace_span(field_name, "gate"):
+                    field_results = controllers[self.controller]()
+
+                if field_results:
+                    # Candidates pruned at this gate hand back their buffers,
+                    # along with the image that entered the gate
+                    for res in field_results[1:]:
+                        if res["img"] is not self.image:
+                            self.release_image(res["img"])
+                    if field_results[0]["img"] is not self.image:
+                        self.release_image(self.image)
+
+                    # Update the control image to the best ranked
+                    self.image = field_results[0]["img"]
+                    self.final_string = field_results[0]["string"]
+                    self.final_score = field_results[0]["score"]
+
+                yield {"field": field_name,
+                       "ranked": [(res["path"], res["score"])
+                                  for res in field_results],
+                       "string": self.final_string,
+                       "score": self.final_score,
+                       "elapsed": time.perf_counter() - start,
+                       }
+        finally:
+            # Also reached when the walk is abandoned early
+            if self.governor is not None:
+                self.governor.restore()
+
+        if not self.verbose:
+            return
+        if self.ocr_calls_saved:
+            print("OCR calls saved by deduplication: " +
+                  str(self.ocr_calls_saved))
+        if self.plan_compiler.steps_eliminated:
+            print("Steps eliminated by the plan compiler: " +
+                  str(self.plan_compiler.steps_eliminated))
 
     # -------------------------------------------------------------------------
     def field_reader(self):
@@ -98,13 +329,20 @@ class FieldManager:
         None
 
         """
+        if getattr(self, "fields", None) is not None:
+            # Plan handed over directly, e.g. by the field optimiser
+            return
+
         params = {"filePath": self.field_file}
         self.fields = Json5Reader(**params).read_json()
 
     # -------------------------------------------------------------------------
-    def list_manipulation_functions(self):
+    def field_validator(self):
         """
-        Gathers a dict of handles of functions within ImageManipulation class
+        Exclude paths that call unknown manipulation functions
+
+        Such paths would be abandoned on every image anyway, so drop them at
+        load time and warn once for the field file
 
         Params
         ------
@@ -115,16 +353,82 @@ class FieldManager:
         None
 
         """
-        foos0 = dict(inspect.getmembers(
-            ImageManipulation(), predicate=inspect.ismethod))
+        abandoned = []
+        fields = {}
+        for field_name, field_data in (self.fields or {}).items():
+            paths = {}
+            for path_name, path_data in field_data.items():
+                unknown = [step["foo"] for step in path_data
+                           if step["foo"] not in self.manip_methods]
+                if unknown:
+                    abandoned.append(field_name + "/" + path_name + " (" +
+                                     ", ".join(unknown) + ")")
+                else:
+                    paths[path_name] = path_data
+            if paths:
+                fields[field_name] = paths
+            else:
+                abandoned.append(field_name + " (no valid paths remain)")
+        self.fields = fields
+        self.abandoned_paths = abandoned
+
+        field_file = str(getattr(self, "field_file", None))
+        if abandoned and field_file not in _warned_field_files:
+            _warned_field_files.add(field_file)
+            print("Unknown manipulation functions within field file: " +
+                  field_file + "\n" + "Excluding: " + "; ".join(abandoned))
 
-        foos1 = {}
-        for foo in foos0.keys():
-            if foo[:2] != "__":
-                # Isn't a dunder, add to foos1
-                foos1[foo] = foos0[foo]
+    # -------------------------------------------------------------------------
+    def path_expander(self, field_data, field_name=None):
+        """
+        Lazily expand the paths of a field, resolving any parameter sweeps,
+        and compile each concrete path
 
-        self.manip_methods = foos1
+        Params
+        ------
+        field_data : <dict> of path name to list of steps
+        field_name : <str> Optional field name, keying the compiled paths
+            kept with cache_paths
+
+        Returns
+        -------
+        <generator> of (path name, list of steps) tuples, or a <list> of
+            them with cache_paths
+
+        """
+        if self.cache_paths and field_name in self.compiled_paths:
+            return self.compiled_paths[field_name]
+
+        params = {"paths": field_data,
+                  "sweep_cap": self.sweep_cap,
+                  "sweep_seed": self.sweep_seed,
+                  }
+        paths = ((path_name, self.plan_compiler.compile_path(path_data))
+                 for path_name, path_data in PathSweep(**params).expand())
+        if self.cache_paths and field_name is not None:
+            paths = self.compiled_paths[field_name] = list(paths)
+        return paths
+
+    # -------------------------------------------------------------------------
+    def list_manipulation_functions(self):
+        """
+        Gathers a dict of handles of the operators within the registry, the
+        ImageManipulation built-ins plus any registered third party operators
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        params = {"pool": self.buffer_pool}
+        for key in ("tile_threshold", "tile_workers"):
+            if getattr(self, key) is not None:
+                params[key] = getattr(self, key)
+        self.manip_methods = REGISTRY.operators(ImageManipulation(**params))
 
     # -------------------------------------------------------------------------
     def path_controller_SMP(self):
@@ -140,19 +444,69 @@ class FieldManager:
         <list> of results
 
         """
-        pool = mp.Pool(ncpus=mp.cpu_count())
-        smp_work = []
+        # The manager and gate image go to each worker once, the tasks carry
+        # only the paths. No img_key, so the workers don't fill their own
+        # throwaway caches
+        initargs = (self, self.image)
+        if self.governor is not None:
+            limits = self.governor.worker_initializer()
+            initargs += (limits["initializer"], limits["initargs"])
+
+        with mp.Pool(processes=self.n_workers, initializer=_init_smp_worker,
+                     initargs=initargs) as pool:
+            # imap pulls the candidates lazily from the sweep expansion
+            smp_results = list(pool.imap(_smp_path_task, self.paths))
+
+            def smp_map(images):
+                return pool.imap(_smp_ocr_task, images)
+
+            self.path_scorer(smp_results, smp_map)
+
+        return self.path_ranker(smp_results)
+
+    # -------------------------------------------------------------------------
+    def path_controller_MT(self):
+        """
+        Threaded controller for paths
+
+        OpenCV and the tesseract subprocess both release the GIL, so threads
+        run the paths concurrently without pickling the image per path
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <list> of results
+
+        """
+        mt_results = []
+
+        img = self.image
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            # Bound the number of candidates in flight so large sweeps are not
+            # all expanded up front
+            in_flight = deque()
+            for path_name, path_data in self.paths:
+                kwargsIn = {"path": path_data,
+                            "path_name": path_name,
+                            "img": img,
+                            "img_key": self.image_key}
+                in_flight.append(pool.submit(self.path_runner, **kwargsIn))
+                if len(in_flight) >= 2 * self.n_workers:
+                    mt_results.append(in_flight.popleft().result())
 
-        smp_results = []
+            while in_flight:
+                mt_results.append(in_flight.popleft().result())
 
-        for path_name, path_data in self.paths.items():
-            kwargsIn = {"path": path_data}
-            smp_work.append(pool.apply_async(self.path_runner, kwds=kwargsIn))
+            def mt_map(images):
+                return pool.map(lambda img: self.ocr_runner(img=img), images)
 
-        for iProcess in range(0, len(smp_work)):
-            smp_results.append(smp_work[iProcess].get())
+            self.path_scorer(mt_results, mt_map)
 
-        return smp_results
+        return self.path_ranker(mt_results)
 
     # -------------------------------------------------------------------------
     def path_controller_ST(self):
@@ -172,16 +526,74 @@ class FieldManager:
 
         img = self.image
 
-        for path_name, path_data in self.paths.items():
+        for path_name, path_data in self.paths:
             kwargsIn = {"path": path_data,
-                        "img": img}
+                        "path_name": path_name,
+                        "img": img,
+                        "img_key": self.image_key}
             rtn = self.path_runner(**kwargsIn)
             st_results.append(rtn)
 
+        def st_map(images):
+            return [self.ocr_runner(img=img) for img in images]
+
+        self.path_scorer(st_results, st_map)
+
+        return self.path_ranker(st_results)
+
+    # -------------------------------------------------------------------------
+    def path_scorer(self, results, ocr_map):
+        """
+        OCR and score the completed paths, each distinct image only once
+
+        Different paths frequently produce byte-identical images, e.g.
+        greyscale then threshold versus threshold alone. Each distinct image
+        is sent to OCR once and its result fanned back to every path that
+        produced it
+
+        Params
+        ------
+        results : <list> of path results, updated in place
+        ocr_map : <callable> taking a list of images, returning an iterable
+            of OCR results in the same order. Lets each controller run the OCR
+            calls with its own workers
+
+        Returns
+        -------
+        None
+
+        """
+        completed = [res for res in results if res["status"] is True]
+
+        digests = [image_digest(res["img"]) for res in completed]
+        unique = {}
+        for digest, res in zip(digests, completed):
+            unique.setdefault(digest, res["img"])
+
+        ocr_results = dict(zip(unique.keys(), ocr_map(list(unique.values()))))
+        for digest, res in zip(digests, completed):
+            res.update(ocr_results[digest])
+
+        self.ocr_calls_saved += len(completed) - len(unique)
+
+    # -------------------------------------------------------------------------
+    def path_ranker(self, results):
+        """
+        Rank the results of the paths walked, best first
+
+        Params
+        ------
+        results : <list> of path results
+
+        Returns
+        -------
+        <list> of results
+
+        """
         # Filter results for paths that didn't complete
-        st_results2 = [res for res in st_results if res["status"] is True]
+        results2 = [res for res in results if res["status"] is True]
         # Rank the results
-        ranked_results = sorted(st_results2, key=lambda d: d["score"],
+        ranked_results = sorted(results2, key=lambda d: d["score"],
                                 reverse=True)
 
         return ranked_results
@@ -189,11 +601,18 @@ class FieldManager:
     # -------------------------------------------------------------------------
     def path_runner(self, **kwargs):
         """
-        Run an individual path
+        Run the manipulation steps of an individual path
+
+        OCR is run separately by path_scorer, so duplicate images across the
+        paths can be caught first
+
+        With an image cache, the longest cached prefix of the steps is taken
+        from it and each intermediate produced after is stored in it
 
         Params
         ------
         kwargs : <dict>
+            img_key : <str> Optional digest of img, enables the image cache
 
         Returns
         -------
@@ -205,40 +624,139 @@ class FieldManager:
 
         img = kwargs["img"]
 
-        for step in list_steps:
-            if not flag_abandoned:
+        cache = self.image_cache if kwargs.get("img_key") else None
+        prefix = ()
+        lookup = cache is not None
+
+        with trace_span(str(kwargs.get("path_name")), "path"):
+            for step in list_steps:
                 foo = step["foo"]
                 params = step["params"]
 
+                if cache is not None:
+                    prefix = prefix + (cache.step_key(step),)
+
                 if foo not in self.manip_methods:
                     # The function requested doesn't exist in the manipulation
                     # methods, cannot continue down this path
                     flag_abandoned = True
-                    img = kwargs["img"]
                     break
-                else:
-                    kwargs1 = {"foo": foo,
-                               "params": params,
-                               "img": img}
+                elif lookup:
+                    cached = cache.get((kwargs["img_key"], prefix))
+                    if cached is not None:
+                        if img is not kwargs["img"]:
+                            self.release_image(img)
+                        img = cached
+                        continue
+                    lookup = False  # Longer prefixes won't be cached either
+
+                kwargs1 = {"foo": foo,
+                           "params": params,
+                           "img": img}
+                if isinstance(params, dict):
+                    # Operators read their params as kwargs
+                    kwargs1.update(params)
+
+                with trace_span(foo, "step", params=params):
+                    new_img = self.manip_methods[foo](**kwargs1)
+
+                # The previous intermediate is finished with
+                if new_img is not img and img is not kwargs["img"]:
+                    self.release_image(img)
+                img = new_img
+
+                if cache is not None and img is not kwargs["img"] and \
+                        cache.put((kwargs["img_key"], prefix), img):
+                    # Held by the cache from now on, never recycled
+                    if self.buffer_pool is not None:
+                        self.buffer_pool.detach(img)
+
+        if flag_abandoned:
+            # Result would be discarded by the ranking, so it never gets
+            # sent to OCR
+            if img is not kwargs["img"]:
+                self.release_image(img)
+            return {"img": kwargs["img"],
+                    "path": kwargs.get("path_name"),
+                    "score": None,
+                    "status": False,
+                    "string": None,
+                    }
 
-                    img = self.manip_methods[foo](**kwargs1)
+        rtn = {"img": img,
+               "path": kwargs.get("path_name"),
+               "score": None,
+               "status": True,
+               "string": None,
+               }
 
-        # Can then send to ocr
-        # In event of abandonment, just send the default image
-        params2 = {"cv2Image": img,
+        return rtn
+
+    # -------------------------------------------------------------------------
+    def ocr_runner(self, **kwargs):
+        """
+        Run OCR on an image and score it
+
+        Params
+        ------
+        kwargs : <dict>
+            img : <image>
+
+        Returns
+        -------
+        <dict> of score and string
+
+        """
+        params2 = {"cv2Image": kwargs["img"],
                    }
         handle = CaptureOCR(**params2)
         handle.image_to_data(**{"lang": "eng+fra"})
         score = handle.return_data("score")
         string = handle.return_data("ocr_string")
 
-        rtn = {"img": img,
-               "score": score,
-               "status": not(flag_abandoned),
-               "string": string,
-               }
+        return {"score": score,
+                "string": string,
+                }
 
-        return rtn
+    # -------------------------------------------------------------------------
+    def release_image(self, img):
+        """
+        Hand an image buffer back to the buffer pool, if one is in use
+
+        Images not from the pool (e.g. the raw image) are ignored by it
+
+        Params
+        ------
+        img : <image>
+
+        Returns
+        -------
+        None
+
+        """
+        if self.buffer_pool is not None:
+            self.buffer_pool.release(img)
+
+    # -------------------------------------------------------------------------
+    def __getstate__(self):
+        """
+        Pickle support for the SMP controller, the lazy path generator cannot
+        be sent to the workers (and isn't needed by them). The images are
+        left out too, the workers are sent the gate image alone
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict>
+
+        """
+        state = self.__dict__.copy()
+        for key in ("paths", "compiled_paths", "image", "raw_image"):
+            state.pop(key, None)
+        return state
 
     # -------------------------------------------------------------------------
     def return_data(self, attr):
@@ -0,0 +1,644 @@
+# -*- coding: utf-8 -*-
+"""
+Offline optimiser for field files
+
+Searches over ImageManipulation operators, their params and the ordering of
+fields against a labelled corpus of images, using an evolutionary search with
+the candidate plans evaluated in parallel. The result is the set of plans on
+the accuracy versus runtime Pareto front, the cheapest of which meeting the
+accuracy target is written out as a new field file.
+
+Corpus layout is a directory of images, each with its expected string either
+in a sidecar text file of the same stem (DiscImage_81.png ->
+DiscImage_81.txt) or in a JSON5 labels file of {"image name": "expected"}
+"""
+
+from pathlib import Path
+
+import argparse
+import copy
+import json
+import multiprocessing as mp
+import random
+import time
+
+import cv2
+import pytesseract as pyt
+
+# My py
+from field_manager import FieldManager
+from image_loader import ImageLoader, IMAGE_SUFFIXES
+from json5_reader import Json5Reader
+
+
+# Search space, the param choices available to each operator
+OPERATOR_SPACE = {
+    "adaptive_resize": [{"MinHeight": h} for h in (20, 28, 36)],
+    "dilate": [{"iterations": i} for i in (1, 2, 3)],
+    "erode": [{"iterations": i} for i in (1, 2, 3)],
+    "greyscale": ["None"],
+    "invert": ["None"],
+    "resize": [{"fx": f, "fy": f} for f in (1.5, 2, 3, 4)],
+    "threshold": [{"Binary_OTSU": "True", "MedianBlur": m}
+                  for m in ("False", "3", "5")],
+}
+
+# Upper limit on the upscaling a generated plan may apply to an image, over
+# all its fields (the winning path's image carries on into the next field).
+# Unbounded, stacked resizes soon exhaust memory
+MAX_PLAN_SCALE = 8
+
+_worker_corpus = None
+_worker_outer_workers = 1
+
+
+# -----------------------------------------------------------------------------
+def _init_worker(corpus, outer_workers=1):
+    """
+    Load the corpus images once per worker process
+
+    Params
+    ------
+    corpus : <list> of (image file, expected string) tuples
+    outer_workers : <int> Number of worker processes, so each walk takes
+        only its share of the cores
+
+    Returns
+    -------
+    None
+
+    """
+    global _worker_corpus, _worker_outer_workers
+    _worker_outer_workers = outer_workers
+    _worker_corpus = []
+    loader = ImageLoader(**{"image_files": [f for f, _ in corpus]})
+    for (_, expected), (_, img) in zip(corpus, loader):
+        if img is not None:
+            _worker_corpus.append((img, expected))
+
+
+# -----------------------------------------------------------------------------
+def _evaluate_plan(plan):
+    """
+    Walk every corpus image through a plan, within a worker process
+
+    OpenCV and tesseract failures on an image, and running out of memory
+    for its intermediates, score it as a miss. Anything else, e.g. a bad param type or tesseract not being installed, is a fault
+    in the search rather than the plan, and is raised
+
+    Params
+    ------
+    plan : <dict> field plan, as per a field file
+
+    Returns
+    -------
+    <dict> of accuracy (fraction of exact matches) and runtime (mean
+        seconds per image)
+
+    """
+    hits = 0
+    runtime = 0
+    for img, expected in _worker_corpus:
+        start = time.perf_counter()
+        try:
+            params = {"fields": plan,
+                      "raw_image": img,
+                      "outer_workers": _worker_outer_workers,
+                      "verbose": False,
+                      }
+            final_string = FieldManager(**params).return_data("final_string")
+        except (cv2.error, pyt.TesseractError, MemoryError) as err:
+            print("Unable to walk plan: " + repr(plan) + ", " + repr(err))
+            final_string = None
+        runtime += time.perf_counter() - start
+
+        if final_string is not None and \
+                final_string.strip() == expected.strip():
+            hits += 1
+
+    n_images = max(len(_worker_corpus), 1)
+    return {"accuracy": hits / n_images,
+            "runtime": runtime / n_images,
+            }
+
+
+# -----------------------------------------------------------------------------
+class FieldOptimizer:
+    """
+    Class for evolving field files against a labelled corpus
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>
+            corpus_dir : <str> directory of labelled images
+            labels_file : <str> Optional JSON5 file of image name to expected
+                string, otherwise sidecar .txt files are used
+            field_file : <str> Optional field file to seed the population
+            accuracy_target : <float> Fraction of exact matches required of
+                the shipped plan
+            population : <int> Number of plans per generation
+            generations : <int> Number of generations to evolve
+            n_workers : <int> Number of processes evaluating plans
+            seed : <int> Optional seed for the search
+
+        Returns
+        -------
+        None
+
+        """
+        self.labels_file = None
+        self.field_file = None
+        self.accuracy_target = 0.9
+        self.population = 16
+        self.generations = 10
+        self.n_workers = mp.cpu_count()
+        self.seed = None
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+        self.rng = random.Random(self.seed)
+        self.corpus_reader()
+
+    # -------------------------------------------------------------------------
+    def corpus_reader(self):
+        """
+        Gather the images and their expected strings
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        corpus_dir = Path(self.corpus_dir)
+        labels = {}
+        if self.labels_file:
+            labels = Json5Reader(**{"filePath": self.labels_file}).read_json()
+            labels = labels or {}
+
+        self.corpus = []
+        for image_file in sorted(corpus_dir.iterdir()):
+            if image_file.suffix.lower() not in IMAGE_SUFFIXES:
+                continue
+            sidecar = image_file.with_suffix(".txt")
+            if image_file.name in labels:
+                expected = labels[image_file.name]
+            elif sidecar.exists():
+                expected = sidecar.read_text()
+            else:
+                print("No expected string for: " + image_file.name +
+                      ", skipping")
+                continue
+            self.corpus.append((str(image_file), expected))
+
+        if not self.corpus:
+            print("No labelled images found within: " + str(corpus_dir))
+
+    # -------------------------------------------------------------------------
+    def optimise(self):
+        """
+        Evolve the plans, evaluating each generation in parallel
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <list> of Pareto front entries, cheapest first, each a <dict> of
+            plan, accuracy and runtime
+
+        """
+        plans = []
+        if self.field_file:
+            seed_plan = Json5Reader(**{"filePath": self.field_file}).read_json()
+            if seed_plan:
+                plans.append(self.plan_sanitiser(seed_plan))
+        while len(plans) < self.population:
+            plans.append(self.random_plan())
+
+        evaluated = {}
+        with mp.Pool(processes=self.n_workers, initializer=_init_worker,
+                     initargs=(self.corpus, self.n_workers)) as pool:
+            for generation in range(self.generations):
+                pending = [plan for plan in plans
+                           if self.plan_key(plan) not in evaluated]
+                for plan, result in zip(pending,
+                                        pool.map(_evaluate_plan, pending)):
+                    result["plan"] = plan
+                    evaluated[self.plan_key(plan)] = result
+
+                ranked = self.pareto_sort(
+                    [evaluated[self.plan_key(plan)] for plan in plans])
+                best = self.pareto_front(ranked)[0]
+                print("Generation " + str(generation) + ": best accuracy " +
+                      str(best["accuracy"]) + " at " +
+                      str(round(best["runtime"], 4)) + " s/image")
+
+                # Survivors are the best half, refill with their offspring
+                parents = [res["plan"] for res in ranked[:max(
+                    2, self.population // 2)]]
+                plans = list(parents)
+                n_rejected = 0
+                while len(plans) < self.population:
+                    child = self.mutate(self.crossover(
+                        self.rng.choice(parents), self.rng.choice(parents)))
+                    if self.plan_scale(child) > MAX_PLAN_SCALE and \
+                            n_rejected < 100 * self.population:
+                        n_rejected += 1
+                        continue
+                    plans.append(child)
+
+        self.front = sorted(self.pareto_front(list(evaluated.values())),
+                            key=lambda d: d["runtime"])
+        return self.front
+
+    # -------------------------------------------------------------------------
+    def write_field_file(self, output_file):
+        """
+        Write the cheapest front plan meeting the accuracy target
+
+        If no plan meets the target, the most accurate plan is written instead
+
+        Params
+        ------
+        output_file : <str> full path to the field file to write
+
+        Returns
+        -------
+        <dict> the front entry written
+
+        """
+        meeting = [res for res in self.front
+                   if res["accuracy"] >= self.accuracy_target]
+        if meeting:
+            chosen = meeting[0]  # Front is sorted cheapest first
+        else:
+            print("No plan met the accuracy target of " +
+                  str(self.accuracy_target) + ", writing the most accurate")
+            chosen = max(self.front, key=lambda d: d["accuracy"])
+
+        header = ["// " + "-" * 72,
+                  "// pyOCRtools",
+                  "// " + "-" * 72,
+                  "// JSON5 file containing the fields and paths",
+                  "// Generated by field_optimizer, accuracy " +
+                  str(chosen["accuracy"]) + ", runtime " +
+                  str(round(chosen["runtime"], 4)) + " s/image",
+                  "// " + "-" * 72,
+                  ]
+        with open(output_file, "w") as f:
+            f.write("\n".join(header) + "\n")
+            f.write(json.dumps(chosen["plan"], indent=4) + "\n")
+        return chosen
+
+    # -------------------------------------------------------------------------
+    def random_plan(self):
+        """
+        Build a random plan of 1-3 fields, each of 1-4 paths of 1-3 steps
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict>
+
+        """
+        plan = None
+        while plan is None or self.plan_scale(plan) > MAX_PLAN_SCALE:
+            plan = {}
+            for i_field in range(self.rng.randint(1, 3)):
+                plan["field" + str(i_field + 1)] = \
+                    {"path" + str(i_path + 1): self.random_path()
+                     for i_path in range(self.rng.randint(1, 4))}
+        return plan
+
+    # -------------------------------------------------------------------------
+    def random_path(self):
+        """
+        Build a random path of 1-3 steps
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <list> of steps
+
+        """
+        return [self.random_step() for _ in range(self.rng.randint(1, 3))]
+
+    # -------------------------------------------------------------------------
+    def random_step(self):
+        """
+        Build a random step from the search space
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict>
+
+        """
+        foo = self.rng.choice(sorted(OPERATOR_SPACE))
+        return {"foo": foo,
+                "params": copy.deepcopy(self.rng.choice(OPERATOR_SPACE[foo])),
+                }
+
+    # -------------------------------------------------------------------------
+    def mutate(self, plan):
+        """
+        Apply a single random mutation to a plan
+
+        Covers operators (step swap/insert/delete), params, paths and the
+        ordering of the fields
+
+        Params
+        ------
+        plan : <dict>
+
+        Returns
+        -------
+        <dict> the mutated plan
+
+        """
+        fields = [copy.deepcopy(paths) for paths in plan.values()]
+        paths = self.rng.choice(fields)
+        path_name = self.rng.choice(sorted(paths))
+        steps = paths[path_name]
+        i_step = self.rng.randrange(len(steps))
+
+        mutation = self.rng.choice(["params", "operator", "insert", "delete",
+                                    "add_path", "drop_path", "add_field",
+                                    "drop_field", "reorder"])
+        if mutation == "params":
+            foo = steps[i_step]["foo"]
+            steps[i_step]["params"] = \
+                copy.deepcopy(self.rng.choice(OPERATOR_SPACE[foo]))
+        elif mutation == "operator":
+            steps[i_step] = self.random_step()
+        elif mutation == "insert" and len(steps) < 4:
+            steps.insert(i_step, self.random_step())
+        elif mutation == "delete" and len(steps) > 1:
+            del steps[i_step]
+        elif mutation == "add_path" and len(paths) < 6:
+            paths["path" + str(len(paths) + 1)] = self.random_path()
+        elif mutation == "drop_path" and len(paths) > 1:
+            del paths[path_name]
+        elif mutation == "add_field" and len(fields) < 4:
+            fields.insert(self.rng.randint(0, len(fields)),
+                          {"path1": self.random_path()})
+        elif mutation == "drop_field" and len(fields) > 1:
+            fields.remove(paths)
+        elif mutation == "reorder" and len(fields) > 1:
+            self.rng.shuffle(fields)
+
+        return self.plan_builder(fields)
+
+    # -------------------------------------------------------------------------
+    def crossover(self, plan_a, plan_b):
+        """
+        One point crossover on the field sequence of two plans
+
+        Params
+        ------
+        plan_a : <dict>
+        plan_b : <dict>
+
+        Returns
+        -------
+        <dict>
+
+        """
+        fields_a = list(plan_a.values())
+        fields_b = list(plan_b.values())
+        cut_a = self.rng.randint(1, len(fields_a))
+        cut_b = self.rng.randint(0, len(fields_b) - 1)
+        fields = copy.deepcopy(fields_a[:cut_a] + fields_b[cut_b:])
+        return self.plan_builder(fields[:4])
+
+    # -------------------------------------------------------------------------
+    def plan_sanitiser(self, plan):
+        """
+        Reduce a seed plan to the operators within the search space
+
+        Params
+        ------
+        plan : <dict>
+
+        Returns
+        -------
+        <dict>
+
+        """
+        fields = []
+        for paths in plan.values():
+            kept = {name: steps for name, steps in paths.items()
+                    if all(step["foo"] in OPERATOR_SPACE for step in steps)}
+            if kept:
+                fields.append(kept)
+        if not fields:
+            return self.random_plan()
+        return self.plan_builder(fields)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def plan_builder(fields):
+        """
+        Assemble an ordered list of fields into a plan, renaming them in order
+
+        Params
+        ------
+        fields : <list> of <dict> of path name to steps
+
+        Returns
+        -------
+        <dict>
+
+        """
+        plan = {}
+        for i_field, paths in enumerate(fields):
+            plan["field" + str(i_field + 1)] = \
+                {"path" + str(i_path + 1): steps
+                 for i_path, steps in enumerate(paths.values())}
+        return plan
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def plan_scale(plan):
+        """
+        Largest upscaling a plan may apply to an image, over all its fields
+
+        Each field may hand on the image of any of its paths, so the scale of
+        a field is that of its largest scaling path, the product of its
+        resizes. adaptive_resize stops at a glyph height, so doesn't compound
+        and isn't counted
+
+        Params
+        ------
+        plan : <dict>
+
+        Returns
+        -------
+        <float>
+
+        """
+        scale = 1.0
+        for paths in plan.values():
+            field_scale = 1.0
+            for steps in paths.values():
+                path_scale = 1.0
+                for step in steps:
+                    params = step.get("params")
+                    if step["foo"] != "resize" or not isinstance(params, dict):
+                        continue
+                    try:
+                        path_scale *= max(float(params.get("fx", 2)),
+                                          float(params.get("fy", 2)))
+                    except (TypeError, ValueError):
+                        continue
+                field_scale = max(field_scale, path_scale)
+            scale *= field_scale
+        return scale
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def plan_key(plan):
+        """
+        Hashable identity of a plan, so repeated plans are evaluated once
+
+        Params
+        ------
+        plan : <dict>
+
+        Returns
+        -------
+        <str>
+
+        """
+        return json.dumps(plan, sort_keys=True)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def dominates(res_a, res_b):
+        """
+        Whether result a Pareto dominates result b
+
+        Params
+        ------
+        res_a : <dict> of accuracy and runtime
+        res_b : <dict> of accuracy and runtime
+
+        Returns
+        -------
+        <bool>
+
+        """
+        no_worse = res_a["accuracy"] >= res_b["accuracy"] and \
+            res_a["runtime"] <= res_b["runtime"]
+        better = res_a["accuracy"] > res_b["accuracy"] or \
+            res_a["runtime"] < res_b["runtime"]
+        return no_worse and better
+
+    # -------------------------------------------------------------------------
+    def pareto_front(self, results):
+        """
+        Gather the non-dominated results
+
+        Params
+        ------
+        results : <list> of <dict>
+
+        Returns
+        -------
+        <list> of <dict>
+
+        """
+        return [res for res in results
+                if not any(self.dominates(other, res) for other in results)]
+
+    # -------------------------------------------------------------------------
+    def pareto_sort(self, results):
+        """
+        Sort results by successive Pareto fronts, most accurate first within
+        each front
+
+        Params
+        ------
+        results : <list> of <dict>
+
+        Returns
+        -------
+        <list> of <dict>
+
+        """
+        remaining = list(results)
+        ranked = []
+        while remaining:
+            front = self.pareto_front(remaining)
+            ranked.extend(sorted(front, key=lambda d: (-d["accuracy"],
+                                                       d["runtime"])))
+            remaining = [res for res in remaining if res not in front]
+        return ranked
+
+    # -------------------------------------------------------------------------
+    def return_data(self, attr):
+        """
+        Return the data 'attr' within the class
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        if hasattr(self, attr):
+            rtn = getattr(self, attr)
+        else:
+            print("Cannot find attribute: " + str(attr) + " to return")
+            rtn = None
+        return rtn
+
+
+# -----------------------------------------------------------------------------
+# ---- main
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evolve a field file against a labelled image corpus")
+    parser.add_argument("corpus_dir")
+    parser.add_argument("output_file")
+    parser.add_argument("--labels_file", default=None)
+    parser.add_argument("--field_file", default=None,
+                        help="Existing field file to seed the search")
+    parser.add_argument("--accuracy_target", type=float, default=0.9)
+    parser.add_argument("--population", type=int, default=16)
+    parser.add_argument("--generations", type=int, default=10)
+    parser.add_argument("--n_workers", type=int, default=mp.cpu_count())
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    handle = FieldOptimizer(**vars(args))
+    front = handle.optimise()
+    for res in front:
+        print(str(res["accuracy"]) + "\t" + str(round(res["runtime"], 4)))
+    handle.write_field_file(args.output_file)
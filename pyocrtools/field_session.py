@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Long lived session walking many images through one field file
+
+Instantiating a FieldManager reads and validates the field file and binds the
+operators, and each walk expands and compiles every path again. A session
+keeps FieldManagers set up between walks, with their compiled paths cached,
+so repeated reads (e.g. pyAutoGUI.getText in a polling loop) pay only for the
+walk itself.
+
+The field file is read once and shared by the session's FieldManagers. Its
+modification time is checked on each read, a changed file is read again and
+the FieldManagers built from the old one are dropped.
+
+A FieldManager holds the state of the walk in progress, so each concurrent
+read takes its own from a pool of idle ones, creating one when none is idle.
+"""
+
+from pathlib import Path
+
+import os
+import sys
+import threading
+import time
+
+# My py
+from field_manager import FieldManager
+from json5_reader import Json5Reader
+
+
+# -----------------------------------------------------------------------------
+class FieldSession:
+    """
+    Class reusing set up FieldManagers across walks
+
+    Thread safe
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>
+            field_file : <str> full path to the field file
+            field_kwargs : <dict> Optional further kwargs for FieldManager,
+                by default walking quietly (verbose False)
+            max_idle : <int> Idle FieldManagers kept (default 4)
+
+        Returns
+        -------
+        None
+
+        """
+        self.field_file = None
+        self.field_kwargs = {}
+        self.max_idle = 4
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+        self._lock = threading.Lock()
+        self._idle = []
+        self._fields = None
+        self._mtime = None
+        self.generation = 0
+        self.managers_created = 0
+        self.reads = 0
+
+    # -------------------------------------------------------------------------
+    def field_mtime(self):
+        """
+        Modification time of the field file
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <int> nanoseconds, None if the file can't be found
+
+        """
+        try:
+            return os.stat(self.field_file).st_mtime_ns
+        except OSError:
+            return None
+
+    # -------------------------------------------------------------------------
+    def acquire(self):
+        """
+        Hand out an idle FieldManager, re-reading the field file if changed
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <tuple> of (FieldManager, generation it was built for)
+
+        """
+        mtime = self.field_mtime()
+        with self._lock:
+            if self._fields is None or mtime != self._mtime:
+                self._fields = Json5Reader(
+                    **{"filePath": self.field_file}).read_json()
+                self._mtime = mtime
+                self._idle = []
+                self.generation += 1
+            if self._idle:
+                return self._idle.pop(), self.generation
+            fields, generation = self._fields, self.generation
+
+        # Set up outside the lock, other reads needn't wait on it
+        # A polling caller would otherwise print on every read
+        params = {"verbose": False}
+        params.update(self.field_kwargs)
+        params.update({"field_file": self.field_file,
+                       "fields": fields,
+                       "walk": False,
+                       "cache_paths": True,
+                       })
+        manager = FieldManager(**params)
+        with self._lock:
+            self.managers_created += 1
+        return manager, generation
+
+    # -------------------------------------------------------------------------
+    def release(self, manager, generation):
+        """
+        Return a FieldManager to the idle pool, unless the field file has
+        changed since it was built
+
+        Params
+        ------
+        manager : <FieldManager>
+        generation : <int> as handed out by acquire
+
+        Returns
+        -------
+        None
+
+        """
+        # The walk's images needn't outlive it
+        manager.raw_image = manager.image = None
+        with self._lock:
+            if generation == self.generation and \
+                    len(self._idle) < self.max_idle:
+                self._idle.append(manager)
+
+    # -------------------------------------------------------------------------
+    def read(self, img):
+        """
+        Walk an image through the fields
+
+        Params
+        ------
+        img : <image> openCV image
+
+        Returns
+        -------
+        <tuple> of (final string, final score)
+
+        """
+        manager, generation = self.acquire()
+        try:
+            for _ in manager.field_walker(**{"raw_image": img}):
+                pass
+            result = (manager.return_data("final_string"),
+                      manager.return_data("final_score"))
+        finally:
+            self.release(manager, generation)
+        with self._lock:
+            self.reads += 1
+        return result
+
+    # -------------------------------------------------------------------------
+    def return_data(self, attr):
+        """
+        Return the data 'attr' within the class
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        if hasattr(self, attr):
+            rtn = getattr(self, attr)
+        else:
+            print("Cannot find attribute: " + str(attr) + " to return")
+            rtn = None
+        return rtn
+
+
+# -----------------------------------------------------------------------------
+# ---- main
+if __name__ == "__main__":
+    # Set up cost per read, everything but the walk itself: a new
+    # FieldManager per read, as getText did, against a session
+    here = Path(__file__).resolve().parent
+    field_file = sys.argv[1] if len(sys.argv) > 1 else \
+        str(here / "field_file.json5")
+    n_reads = 200
+
+    def fresh():
+        manager = FieldManager(**{"field_file": field_file, "walk": False})
+        for field_name, field_data in manager.fields.items():
+            list(manager.path_expander(field_data, field_name))
+
+    def reuse():
+        manager, generation = session.acquire()
+        for field_name, field_data in manager.fields.items():
+            list(manager.path_expander(field_data, field_name))
+        session.release(manager, generation)
+
+    session = FieldSession(**{"field_file": field_file})
+    for name, func in (("new FieldManager per read", fresh),
+                       ("session", reuse)):
+        start = time.perf_counter()
+        for _ in range(n_reads):
+            func()
+        print(name + ": " + str(round((time.perf_counter() - start) /
+                                      n_reads * 1000, 3)) + " ms set up")
+    print(str(session.return_data("managers_created")) +
+          " FieldManager(s) created by the session")
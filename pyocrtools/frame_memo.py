@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Memo of the last OCR result per screen region, reused while it is unchanged
+
+GUI tests poll the same region while waiting for a state change, and most
+captures are identical to the previous one. Each region keeps the digest of
+the frame its result was read from (and, for a non-zero tolerance, the frame
+itself), so an unchanged capture hands back the result without walking the
+fields again.
+
+Frames are compared against the one the result was read from, not the
+previous capture, so slow drift within the tolerance can't accumulate.
+"""
+
+from collections import OrderedDict
+
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# My py
+from image_manipulation import image_digest
+
+
+# -----------------------------------------------------------------------------
+class FrameMemo:
+    """
+    Class holding the last result per region, keyed by the caller
+
+    Thread safe
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>
+            tolerance : <float> Mean absolute difference, in grey levels, up
+                to which a frame is unchanged. 0 (default) requires it to be
+                byte-identical
+            max_regions : <int> Regions remembered, least recently used are
+                dropped beyond this (default 64)
+
+        Returns
+        -------
+        None
+
+        """
+        self.tolerance = 0
+        self.max_regions = 64
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # -------------------------------------------------------------------------
+    def unchanged(self, entry, img, tolerance):
+        """
+        Whether a frame matches the one an entry was read from
+
+        Params
+        ------
+        entry : <dict> memo entry
+        img : <image> new frame
+        tolerance : <float>
+
+        Returns
+        -------
+        <bool>
+
+        """
+        if entry["shape"] != img.shape:
+            return False
+        if entry["digest"] == image_digest(img):
+            return True
+        if tolerance <= 0 or entry["frame"] is None:
+            return False
+        diff = cv2.absdiff(entry["frame"], img)
+        return float(np.mean(diff)) <= tolerance
+
+    # -------------------------------------------------------------------------
+    def lookup(self, key, img, tolerance=None):
+        """
+        Result for a region, if the frame is unchanged
+
+        Params
+        ------
+        key : <hashable> region key, e.g. (BoundBox, field file)
+        img : <image> new frame
+        tolerance : <float> Optional override of the memo's tolerance
+
+        Returns
+        -------
+        <tuple> of (found, result)
+
+        """
+        tolerance = self.tolerance if tolerance is None else tolerance
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and img is not None and \
+                self.unchanged(entry, img, tolerance):
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                self.hits += 1
+            return True, entry["result"]
+
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    # -------------------------------------------------------------------------
+    def store(self, key, img, result, tolerance=None):
+        """
+        Remember the result read from a frame
+
+        Params
+        ------
+        key : <hashable> region key
+        img : <image> frame the result was read from
+        result : the result
+        tolerance : <float> Optional override of the memo's tolerance, the
+            frame itself is only kept where it is non-zero
+
+        Returns
+        -------
+        None
+
+        """
+        if img is None:
+            return
+        tolerance = self.tolerance if tolerance is None else tolerance
+        entry = {"shape": img.shape,
+                 "digest": image_digest(img),
+                 "frame": img.copy() if tolerance > 0 else None,
+                 "result": result,
+                 "time": time.time(),
+                 }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_regions:
+                self._entries.popitem(last=False)
+
+    # -------------------------------------------------------------------------
+    def forget(self, key=None):
+        """
+        Drop the entry of a region, or all of them
+
+        Params
+        ------
+        key : <hashable> Optional region key, None for all
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    # -------------------------------------------------------------------------
+    def return_data(self, attr):
+        """
+        Return the data 'attr' within the class
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        if hasattr(self, attr):
+            rtn = getattr(self, attr)
+        else:
+            print("Cannot find attribute: " + str(attr) + " to return")
+            rtn = None
+        return rtn
+
+
+# -----------------------------------------------------------------------------
+# ---- main
+if __name__ == "__main__":
+    # Cost of deciding a polled 400x120 region is unchanged, exactly and
+    # within a tolerance, against the walk it saves
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (120, 400, 3), dtype=np.uint8)
+    blinked = frame.copy()
+    blinked[40:80, 200:202] = 0  # A cursor blink
+
+    for tolerance in (0, 1.0):
+        memo = FrameMemo(**{"tolerance": tolerance})
+        memo.store("region", frame, "text")
+        start = time.perf_counter()
+        for _ in range(1000):
+            found_same, _ = memo.lookup("region", frame.copy())
+        same_us = (time.perf_counter() - start) * 1000
+        found_blink, _ = memo.lookup("region", blinked)
+        print("tolerance " + str(tolerance) + ": unchanged frame found " +
+              str(found_same) + " in " + str(round(same_us, 1)) +
+              " us, cursor blink found " + str(found_blink))
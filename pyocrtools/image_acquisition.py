@@ -4,14 +4,21 @@ Created on Wed Jun 29 13:25:57 2022
 
 brendan.sloan@mourneaerospace.com
 """
-from copy import deepcopy
+from collections import deque
 from pathlib import Path
 
+import sys
+import threading
+import time
+
 import numpy as np
 
 import cv2
 import pyscreeze
 
+# My py
+from trace_events import trace_span
+
 
 # -----------------------------------------------------------------------------
 def get_variable(kwargs, class_handle, name, optional=False):
@@ -42,6 +49,41 @@ def get_variable(kwargs, class_handle, name, optional=False):
     return var
 
 
+# -----------------------------------------------------------------------------
+def pil_to_bgr(pil_image, writable=False):
+    """
+    Convert a PIL image to a contiguous uint8 OpenCV array
+
+    PIL packs the channels in BGR order as it writes out its buffer, which is
+    wrapped without a copy, as a read-only array. Callers that draw on the
+    image copy it first, or pass writable True
+
+    Params
+    ------
+    pil_image : <PIL.Image> RGB or RGBA (to BGRA), greyscale images are kept
+        single channel and any other mode is converted to RGB first
+    writable : <bool> Return a writable array, at the cost of a copy of the
+        buffer (default False)
+
+    Returns
+    -------
+    <numpy array> (H, W, 3), (H, W, 4) or (H, W) uint8
+
+    """
+    width, height = pil_image.size
+    if pil_image.mode == "L":
+        raw, shape = pil_image.tobytes(), (height, width)
+    elif pil_image.mode == "RGBA":
+        raw, shape = pil_image.tobytes("raw", "BGRA"), (height, width, 4)
+    else:
+        if pil_image.mode != "RGB":
+            pil_image = pil_image.convert("RGB")
+        raw, shape = pil_image.tobytes("raw", "BGR"), (height, width, 3)
+    if writable:
+        raw = bytearray(raw)
+    return np.frombuffer(raw, np.uint8).reshape(shape)
+
+
 # -----------------------------------------------------------------------------
 class AcquireImage:
     """
@@ -83,7 +125,9 @@ class AcquireImage:
             ImageFile : <str> full path to image
             BoundBox : <tuple> 4 entry tuple of (left, top, width, height)
                 for downselecting a region to screen shot. Very useful for OCR
-            [Both above optional if already in class variables via
+            Session : <ScreenSession> Optional open capture session to grab
+                from, rather than a fresh pyscreeze screenshot
+            [All above optional if already in class variables via
              instantiation]
 
         Returns
@@ -93,42 +137,47 @@ class AcquireImage:
 
         """
         bound_box = get_variable(kwargs, self, "BoundBox", optional=True)
+        session = get_variable(kwargs, self, "Session", optional=True)
         try:
-            if not bound_box:
-                self.raw_image = pyscreeze.screenshot()
-            else:
-                self.raw_image = pyscreeze.screenshot(region=bound_box)
-
-            self.convert_RGB_to_BGR()
+            with trace_span("screen_shot", "capture", region=bound_box):
+                if session is not None:
+                    # Already BGR, there is no PIL image to convert
+                    self.raw_image = None
+                    self.cv_image = session.grab_bgr(bound_box)
+                else:
+                    if not bound_box:
+                        self.raw_image = pyscreeze.screenshot()
+                    else:
+                        self.raw_image = pyscreeze.screenshot(
+                            region=bound_box)
+
+                    self.convert_RGB_to_BGR()
 
         except Exception:
             print("Failed to acquire/convert a screenshot")
 
     # -------------------------------------------------------------------------
-    def convert_RGB_to_BGR(self, unit_type="uint32"):
+    def convert_RGB_to_BGR(self, unit_type="uint8"):
         """
         Convert a RGB format image to an BGR numpy array
 
         Params
         ------
         unit_type : <string> Unsigned integer unit type for the numpy array
-            [Optional param, default is uint32, often seen uint8 used too]
+            [Optional param, default is uint8 as OpenCV expects, any other
+             costs a further conversion. Was uint32 before, pass "uint32"
+             for the previous behaviour]
 
         Returns
         -------
-        openCV image
+        openCV image, read-only as uint8, copy it to draw on it
 
         """
         self.cv_image = None
         if self.raw_image:
-            img0 = np.asarray(self.raw_image, dtype=unit_type)
-
-            # Convert to BGR as per below
-            img = deepcopy(img0)
-            img[0,:,0] = img0[0,:,2]
-            img[0,:,2] = img0[0,:,0]
-            img[1,:,0] = img0[1,:,2]
-            img[1,:,2] = img0[1,:,0]
+            img = pil_to_bgr(self.raw_image)
+            if np.dtype(unit_type) != np.uint8:
+                img = img.astype(unit_type)
 
             self.cv_image = img
         else:
@@ -136,6 +185,245 @@ class AcquireImage:
 
         return self.cv_image
 
+    # -------------------------------------------------------------------------
+    def screen_shot_regions(self, **kwargs):
+        """
+        Acquire several regions from a single screenshot, of their union
+
+        Params
+        ------
+        kwargs : <dict>
+            BoundBoxes : <list> of (left, top, width, height) tuples
+            Session : <ScreenSession> Optional open capture session
+            [Both above optional if already in class variables via
+             instantiation]
+
+        Returns
+        -------
+        <list> of openCV images per BoundBox, views into the one capture
+            (cv_image), None if the capture failed
+
+        """
+        bound_boxes = get_variable(kwargs, self, "BoundBoxes")
+        session = get_variable(kwargs, self, "Session", optional=True)
+        self.region_images = None
+        if not bound_boxes:
+            return self.region_images
+        if any(len(box) != 4 or box[2] <= 0 or box[3] <= 0
+               for box in bound_boxes):
+            print("BoundBoxes must each be (left, top, width, height) " +
+                  "with a positive width and height")
+            return self.region_images
+
+        left = min(box[0] for box in bound_boxes)
+        top = min(box[1] for box in bound_boxes)
+        union = (left, top,
+                 max(box[0] + box[2] for box in bound_boxes) - left,
+                 max(box[1] + box[3] for box in bound_boxes) - top)
+        try:
+            with trace_span("screen_shot_regions", "capture", region=union,
+                            n_regions=len(bound_boxes)):
+                self.cv_image = self.grab_frame(union, session)
+        except Exception:
+            print("Failed to acquire/convert a screenshot")
+            return self.region_images
+
+        if self.cv_image is not None:
+            self.region_images = [
+                self.cv_image[box[1] - top:box[1] - top + box[3],
+                              box[0] - left:box[0] - left + box[2]]
+                for box in bound_boxes]
+        return self.region_images
+
+    # -------------------------------------------------------------------------
+    def grab_frame(self, bound_box, session):
+        """
+        Capture a single BGR frame, via the session where given
+
+        Params
+        ------
+        bound_box : <tuple> Optional (left, top, width, height)
+        session : <ScreenSession> Optional open capture session
+
+        Returns
+        -------
+        openCV image, read-only without MIT-SHM, copy it to draw on it
+
+        """
+        if session is not None:
+            return session.grab_bgr(bound_box)
+        if not bound_box:
+            return pil_to_bgr(pyscreeze.screenshot())
+        return pil_to_bgr(pyscreeze.screenshot(region=bound_box))
+
+    # -------------------------------------------------------------------------
+    def start_capture(self, **kwargs):
+        """
+        Start capturing frames in the background into a bounded ring buffer
+
+        Lets a polling loop OCR one frame while the next is captured, reading
+        them back via latest_frame or frame_after. Frames are timestamped
+        with time.perf_counter() as their capture starts, so a frame after t
+        shows the screen as it was after t
+
+        Params
+        ------
+        kwargs : <dict>
+            BoundBox : <tuple> Optional (left, top, width, height) region
+            Session : <ScreenSession> Optional open capture session
+            ring_size : <int> Frames held, the oldest are dropped (default 8)
+            interval : <float> Minimum seconds between captures (default 0)
+            [BoundBox and Session optional if already in class variables via
+             instantiation]
+
+        Returns
+        -------
+        None
+
+        """
+        self.stop_capture()
+        self._capture_box = get_variable(kwargs, self, "BoundBox",
+                                         optional=True)
+        self._capture_session = get_variable(kwargs, self, "Session",
+                                             optional=True)
+        self._capture_interval = kwargs.get("interval", 0)
+        self._frames = deque(maxlen=kwargs.get("ring_size", 8))
+        self._frames_cond = threading.Condition()
+        self._capture_stop = threading.Event()
+        self.frames_captured = 0
+        self._capture_thread = threading.Thread(
+            target=self.capture_loop, name="capture", daemon=True)
+        self._capture_thread.start()
+
+    # -------------------------------------------------------------------------
+    def capture_loop(self):
+        """
+        Body of the background capture thread
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        while not self._capture_stop.is_set():
+            stamp = time.perf_counter()
+            try:
+                with trace_span("capture_frame", "capture",
+                                region=self._capture_box):
+                    img = self.grab_frame(self._capture_box,
+                                          self._capture_session)
+            except Exception as err:
+                print("Background capture stopped, failed to acquire a " +
+                      "screenshot: " + str(err))
+                break
+
+            if img is not None:
+                with self._frames_cond:
+                    self._frames.append((stamp, img))
+                    self.frames_captured += 1
+                    self._frames_cond.notify_all()
+
+            wait = self._capture_interval - (time.perf_counter() - stamp)
+            if wait > 0:
+                self._capture_stop.wait(wait)
+
+        self._capture_stop.set()
+        with self._frames_cond:
+            self._frames_cond.notify_all()  # Release any waiting readers
+
+    # -------------------------------------------------------------------------
+    def capturing(self):
+        """
+        Whether the background capture is running
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <bool>
+
+        """
+        return getattr(self, "_capture_stop", None) is not None and \
+            not self._capture_stop.is_set()
+
+    # -------------------------------------------------------------------------
+    def latest_frame(self, timeout=None):
+        """
+        Most recent frame of the background capture, waiting for the first
+
+        Params
+        ------
+        timeout : <float> Optional seconds to wait for a frame
+
+        Returns
+        -------
+        <tuple> of (timestamp, openCV image), None if there is none
+
+        """
+        return self.frame_after(float("-inf"), timeout, latest=True)
+
+    # -------------------------------------------------------------------------
+    def frame_after(self, stamp, timeout=None, latest=False):
+        """
+        First frame of the background capture taken after a time, waiting
+        for it to be captured if need be
+
+        Params
+        ------
+        stamp : <float> time.perf_counter() time
+        timeout : <float> Optional seconds to wait
+        latest : <bool> Return the most recent such frame rather than the
+            first
+
+        Returns
+        -------
+        <tuple> of (timestamp, openCV image), None on timeout or if the
+            capture has stopped
+
+        """
+        if getattr(self, "_frames_cond", None) is None:
+            print("Background capture has not been started")
+            return None
+
+        def find():
+            frames = reversed(self._frames) if latest else self._frames
+            for frame in frames:
+                if frame[0] > stamp:
+                    return frame
+            return None
+
+        with self._frames_cond:
+            self._frames_cond.wait_for(
+                lambda: find() is not None or self._capture_stop.is_set(),
+                timeout)
+            return find()
+
+    # -------------------------------------------------------------------------
+    def stop_capture(self):
+        """
+        Stop the background capture, frames already held remain readable
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        if getattr(self, "_capture_thread", None) is None:
+            return
+        self._capture_stop.set()
+        self._capture_thread.join()
+        self._capture_thread = None
+
     # -------------------------------------------------------------------------
     def open_image(self, **kwargs):
         """
@@ -144,6 +432,12 @@ class AcquireImage:
         Params
         ------
         kwargs : <dict>
+            ImageFile : <str> full path to image
+            DecodeHints : <dict> Optional hints from
+                PlanCompiler.decode_hints, to decode straight to greyscale or
+                a reduced resolution where the plan allows
+            [Both above optional if already in class variables via
+             instantiation]
 
         Returns
         -------
@@ -152,10 +446,14 @@ class AcquireImage:
         """
         self.cv_image = None
         image_file = get_variable(kwargs, self, "ImageFile")
+        decode_hints = get_variable(kwargs, self, "DecodeHints",
+                                    optional=True)
+        flags = cv2.IMREAD_COLOR if not decode_hints else \
+            decode_hints["imread_flags"]
         if image_file:
             if Path(image_file).exists():
-                self.cv_image = cv2.imread(image_file)
-                # Load using default params
+                with trace_span("open_image", "capture", file=image_file):
+                    self.cv_image = cv2.imread(image_file, flags)
             else:
                 print("Invalid image file path specified, file not found")
 
@@ -234,3 +532,40 @@ if __name__ == "__main__":
     handle7 = AcquireImage(**params)
     r7a = handle7.open_image()
     r7b = handle7.return_data("cv_image")
+
+    # -------------------------------------------------------------------------
+    # Benchmark the BGR conversion of a full screen capture, against the
+    # previous uint32 copy with its channel swap. Uses a synthetic 4K capture
+    # unless "screen" is given
+    from copy import deepcopy
+
+    from PIL import Image
+
+    if "screen" in sys.argv[1:]:
+        screen = pyscreeze.screenshot()
+    else:
+        rng = np.random.default_rng(0)
+        screen = Image.fromarray(
+            rng.integers(0, 256, (2160, 3840, 3), dtype=np.uint8))
+
+    def previous_conversion(pil_image):
+        img0 = np.asarray(pil_image, dtype="uint32")
+        img = deepcopy(img0)
+        img[..., 0] = img0[..., 2]
+        img[..., 2] = img0[..., 0]
+        return img
+
+    expected = cv2.cvtColor(np.asarray(screen.convert("RGB")),
+                            cv2.COLOR_RGB2BGR)
+    print("pil_to_bgr matches cv2.cvtColor: " +
+          str(np.array_equal(pil_to_bgr(screen.convert("RGB")), expected)))
+    for name, func in (("previous uint32 copy", previous_conversion),
+                       ("pil_to_bgr", pil_to_bgr),
+                       ("pil_to_bgr, writable",
+                        lambda pil_image: pil_to_bgr(pil_image, True))):
+        start = time.perf_counter()
+        for _ in range(10):
+            out = func(screen)
+        print(name + ": " +
+              str(round((time.perf_counter() - start) * 100, 1)) +
+              " ms per capture, " + str(out.nbytes // 2**20) + " MB")
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-budgeted LRU cache of intermediate images
+
+Entries are keyed by the digest of the image entering a gate plus the prefix
+of steps applied to it, so paths sharing a prefix (within a gate, across
+gates, or across repeated captures of the same screen) only run it once.
+The least recently used entries are evicted once the total bytes held exceed
+the budget.
+
+Cached images are made read-only, as they are handed to every path sharing
+the prefix. SHARED_CACHE may be given to every FieldManager in the process.
+"""
+
+from collections import OrderedDict
+
+import json
+import threading
+
+
+# -----------------------------------------------------------------------------
+class ImageCache:
+    """
+    Class holding intermediate images within a byte budget
+
+    Thread safe, so may be shared by the MT path controller and sessions
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>
+            max_bytes : <int> budget for the images held (default 256 MB)
+
+        Returns
+        -------
+        None
+
+        """
+        self.max_bytes = 256 * 1024 * 1024
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def step_key(step):
+        """
+        Hashable key of a path step
+
+        Params
+        ------
+        step : <dict>
+
+        Returns
+        -------
+        <str>
+
+        """
+        return json.dumps(step, sort_keys=True, default=str)
+
+    # -------------------------------------------------------------------------
+    def get(self, key):
+        """
+        Look up an image, marking it most recently used
+
+        Params
+        ------
+        key : <tuple> of (image digest, tuple of step keys)
+
+        Returns
+        -------
+        <image> read-only, or None on a miss
+
+        """
+        with self._lock:
+            img = self._entries.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return img
+
+    # -------------------------------------------------------------------------
+    def put(self, key, img):
+        """
+        Store an image, evicting the least recently used beyond the budget
+
+        The caller must not modify the image afterwards, it is made read-only
+
+        Params
+        ------
+        key : <tuple> of (image digest, tuple of step keys)
+        img : <image>
+
+        Returns
+        -------
+        <bool> True if stored, images larger than the budget are not
+
+        """
+        if img.nbytes > self.max_bytes:
+            return False
+
+        img.flags.writeable = False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.nbytes
+            self._entries[key] = img
+            self.bytes += img.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+        return True
+
+    # -------------------------------------------------------------------------
+    def clear(self):
+        """
+        Drop all entries, the statistics are kept
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    # -------------------------------------------------------------------------
+    def stats(self):
+        """
+        Cache statistics
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict>
+
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries),
+                    "bytes": self.bytes,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else None,
+                    }
+
+    # -------------------------------------------------------------------------
+    def __getstate__(self):
+        """
+        Pickle as an empty cache, SMP workers each build their own
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <dict>
+
+        """
+        return {"max_bytes": self.max_bytes}
+
+    # -------------------------------------------------------------------------
+    def __setstate__(self, state):
+        """
+        Rebuild an empty cache in the receiving process
+
+        Params
+        ------
+        state : <dict>
+
+        Returns
+        -------
+        None
+
+        """
+        self.__init__(**state)
+
+
+SHARED_CACHE = ImageCache()
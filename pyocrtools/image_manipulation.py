@@ -5,11 +5,16 @@ Created on Fri Jul  1 09:51:46 2022
 @author: brendans1020
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
+import hashlib
+import os
+import threading
 
 import matplotlib.pyplot as plt
+import multiprocessing as mp
 import numpy as np
 
 #My py
@@ -17,12 +22,438 @@ from image_acquisition import AcquireImage
 from json5_reader import Json5Reader
 
 
+# Structuring element of dilate/erode
+MORPH_KERNEL = (1, 1)
+
+# Minimum local contrast (grey levels) for a pixel to be counted as text edge
+# by text_bounding_box, so flat backgrounds with slight noise are not
+TEXT_EDGE_CONTRAST = 32
+
+# Glyph height (pixels) adaptive_resize scales text up to. Tesseract is most
+# accurate with glyphs some 20 to 40 pixels tall, and gains little above
+TEXT_GLYPH_HEIGHT = 28
+
+# Image size (pixels) up to which a batch resize is made as one tall image.
+# Above this the padding and the copy out of the tall image cost more than
+# the per image OpenCV calls they save
+BATCH_RESIZE_MAX_PIXELS = 64 * 128
+
+# Thread pools for tiled execution, per process (a forked child can't use its
+# parent's threads) and worker count
+_tile_executors = {}
+_tile_executors_lock = threading.Lock()
+
+
+# -----------------------------------------------------------------------------
+def image_digest(img):
+    """
+    Hash an image buffer, including its shape and dtype
+
+    Two images with the same digest are byte-identical, so will give the same
+    OCR result
+
+    Params
+    ------
+    img : <image>
+
+    Returns
+    -------
+    <str>
+
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((img.shape, img.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(img).data)
+    return digest.hexdigest()
+
+
+# -----------------------------------------------------------------------------
+def stack_images(images):
+    """
+    Stack equal-shaped images into a single (N, H, W[, C]) array for the
+    batch mode of the ImageManipulation operators
+
+    Params
+    ------
+    images : <list> of <image>
+
+    Returns
+    -------
+    <numpy array>
+
+    """
+    return np.ascontiguousarray(np.stack(images))
+
+
+# -----------------------------------------------------------------------------
+def text_bounding_box(img, padding=8, batch=False):
+    """
+    Find the tight region of an image containing text, plus padding
+
+    Text edges are found with a 3x3 morphological gradient (the local
+    max - min), thresholded by Otsu but never below TEXT_EDGE_CONTRAST. The
+    region is then the extent of the row and column projection profiles of
+    the edges. Works for dark text on light and light text on dark alike
+
+    Params
+    ------
+    img : <image> greyscale or BGR, or with batch a (N, H, W[, C]) stack
+    padding : <int> pixels to pad the region by, clamped to the image
+    batch : <bool> img is a stack, giving the union region over it
+
+    Returns
+    -------
+    <tuple> (x, y, w, h) of the region, or None if no text edges are found
+
+    """
+    if batch:
+        # A stack, take the union of the edges over the images
+        edges = np.maximum.reduce([_text_edges(image) for image in img])
+    else:
+        edges = _text_edges(img)
+
+    # numpy's max along rows is several times quicker than cv2.reduce
+    rows = np.flatnonzero(edges.max(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(edges.max(axis=0))
+
+    height, width = edges.shape
+    x0 = max(int(cols[0]) - padding, 0)
+    y0 = max(int(rows[0]) - padding, 0)
+    x1 = min(int(cols[-1]) + 1 + padding, width)
+    y1 = min(int(rows[-1]) + 1 + padding, height)
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+# -----------------------------------------------------------------------------
+def glyph_height(img):
+    """
+    Estimate the height of the text glyphs within an image
+
+    The image is binarised by Otsu, with the minority class taken as text,
+    and the median height of its connected components taken. Components that
+    span the image (frames, backgrounds) or are long and flat (underlines,
+    rules) are ignored
+
+    Params
+    ------
+    img : <image> greyscale or BGR
+
+    Returns
+    -------
+    <float> median glyph height in pixels, or None if no glyphs are found
+
+    """
+    grey = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    binary = cv2.threshold(grey, 0, 255,
+                           cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    if cv2.countNonZero(binary) > binary.size // 2:
+        binary = cv2.bitwise_not(binary)  # Text as the foreground
+
+    # Grana's algorithm gathers the stats in under half the time of the
+    # default (Spaghetti) on text
+    stats = cv2.connectedComponentsWithStatsWithAlgorithm(
+        binary, 8, cv2.CV_32S, cv2.CCL_GRANA)[2][1:]
+    heights = stats[:, cv2.CC_STAT_HEIGHT]
+    widths = stats[:, cv2.CC_STAT_WIDTH]
+    keep = (heights >= 3) & (heights < 0.9 * grey.shape[0]) & \
+        (widths < 0.9 * grey.shape[1]) & (widths <= 3 * heights)
+    if not keep.any():
+        return None
+    return float(np.median(heights[keep]))
+
+
+# -----------------------------------------------------------------------------
+def adaptive_scale(img, min_height=TEXT_GLYPH_HEIGHT, max_scale=8,
+                   batch=False):
+    """
+    Smallest scale bringing the text glyphs of an image up to min_height
+
+    Params
+    ------
+    img : <image> greyscale or BGR, or with batch a (N, H, W[, C]) stack
+    min_height : <float> target glyph height in pixels
+    max_scale : <float> upper limit on the scale
+    batch : <bool> img is a stack, giving the scale for its smallest text
+
+    Returns
+    -------
+    <float> scale, in quarter steps, 1.0 if no upscaling is needed (or no
+        text was found)
+
+    """
+    if batch:
+        heights = [glyph_height(image) for image in img]
+        heights = [height for height in heights if height is not None]
+        height = min(heights) if heights else None
+    else:
+        height = glyph_height(img)
+
+    if height is None or height >= min_height:
+        return 1.0
+    return min(float(max_scale), np.ceil(4 * min_height / height) / 4)
+
+
+# -----------------------------------------------------------------------------
+def _text_edges(img):
+    """
+    Binary mask of the text edges within an image
+
+    Params
+    ------
+    img : <image> greyscale or BGR
+
+    Returns
+    -------
+    <numpy array> uint8 of 0 or 255
+
+    """
+    grey = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    gradient = cv2.morphologyEx(grey, cv2.MORPH_GRADIENT,
+                                np.ones((3, 3), np.uint8))
+    thresh = cv2.threshold(gradient, 0, 255,
+                           cv2.THRESH_BINARY + cv2.THRESH_OTSU)[0]
+    return cv2.threshold(gradient, max(thresh, TEXT_EDGE_CONTRAST), 255,
+                         cv2.THRESH_BINARY)[1]
+
+
+# -----------------------------------------------------------------------------
+def _tile_rows(img, func, halo, out, n_workers, fy=1):
+    """
+    Apply a filter to horizontal strips of an image across a thread pool
+
+    Each strip is extended by halo rows of its neighbours, which covers the
+    filter's support so the rows kept from it are identical to filtering the
+    whole image. The strips share the image's true top and bottom borders, so
+    border handling is unchanged too
+
+    Params
+    ------
+    img : <image>
+    func : <callable> filter taking and returning an image, row count scaled
+        by the whole number fy
+    halo : <int> rows of support either side of an output row
+    out : <numpy array> full output image, written in place
+    n_workers : <int> number of threads
+    fy : <int> vertical scale of func's output
+
+    Returns
+    -------
+    <numpy array> out
+
+    """
+    height = img.shape[0]
+    # Strips of at least a few halos, or the overlap dominates
+    n_tiles = max(1, min(n_workers, height // max(4 * halo, 64)))
+    bounds = np.linspace(0, height, n_tiles + 1).astype(int)
+
+    def run_tile(i_tile):
+        start, stop = bounds[i_tile], bounds[i_tile + 1]
+        src_start = max(start - halo, 0)
+        src_stop = min(stop + halo, height)
+        rtn = func(img[src_start:src_stop])
+        offset = (start - src_start) * fy
+        out[start*fy:stop*fy] = rtn[offset:offset + (stop - start) * fy]
+
+    key = (os.getpid(), n_workers)
+    with _tile_executors_lock:
+        if key not in _tile_executors:
+            _tile_executors[key] = ThreadPoolExecutor(
+                max_workers=n_workers, thread_name_prefix="tile")
+        executor = _tile_executors[key]
+    list(executor.map(run_tile, range(n_tiles)))
+    return out
+
+
+# -----------------------------------------------------------------------------
+def _batch_rows(stack):
+    """
+    View an image stack as one tall image, for per-pixel operations
+
+    Params
+    ------
+    stack : <numpy array> (N, H, W[, C])
+
+    Returns
+    -------
+    <numpy array> (N*H, W[, C])
+
+    """
+    stack = np.ascontiguousarray(stack)
+    return stack.reshape((-1,) + stack.shape[2:])
+
+
+# -----------------------------------------------------------------------------
+def _batch_morphology(stack, func, radius, border_value):
+    """
+    Apply an erode/dilate to every image of a stack in one call
+
+    Images are separated by rows of the morphology border value (which never
+    wins the min/max), so no image's kernel reaches into its neighbour and the
+    result is identical to filtering each separately
+
+    Params
+    ------
+    stack : <numpy array> (N, H, W[, C])
+    func : <callable> taking and returning an image
+    radius : <int> vertical reach of the kernel over all iterations
+    border_value : <int> 255 for erode, 0 for dilate
+
+    Returns
+    -------
+    <numpy array> (N, H, W[, C])
+
+    """
+    height = stack.shape[1]
+    if radius:
+        pad_width = ((0, 0), (radius, radius)) + ((0, 0),) * (stack.ndim - 2)
+        stack = np.pad(stack, pad_width, mode="constant",
+                       constant_values=border_value)
+    rtn = func(_batch_rows(stack)).reshape(stack.shape)
+    return np.ascontiguousarray(rtn[:, radius:radius+height])
+
+
+# -----------------------------------------------------------------------------
+def _batch_median_blur(stack, ksize):
+    """
+    Median blur every image of a greyscale stack in one call
+
+    Images are padded left and right by replication and laid side by side as
+    one wide image, so no image's kernel reaches into its neighbour and the
+    result is identical to blurring each separately. Wide rather than tall as
+    OpenCV's median filter is far quicker along long rows
+
+    Params
+    ------
+    stack : <numpy array> (N, H, W)
+    ksize : <int> odd kernel size
+
+    Returns
+    -------
+    <numpy array> (N, H, W)
+
+    """
+    radius = ksize // 2
+    n_images, height, width = stack.shape
+    padded = np.pad(stack, ((0, 0), (0, 0), (radius, radius)), mode="edge")
+    wide = np.ascontiguousarray(padded.transpose(1, 0, 2)).reshape(height, -1)
+    blurred = cv2.medianBlur(wide, ksize)
+    blurred = blurred.reshape(height, n_images, width + 2*radius)
+    return np.ascontiguousarray(
+        blurred[:, :, radius:radius+width].transpose(1, 0, 2))
+
+
+# -----------------------------------------------------------------------------
+def _batch_resize(stack, fx, fy, interpolation):
+    """
+    Resize every image of a stack
+
+    Small images (up to BATCH_RESIZE_MAX_PIXELS) are padded top and bottom by
+    replication and resized as one tall image, identical to resizing each
+    separately, for linear interpolation with a whole number fy, and cubic
+    (the default) with whole number fx and fy on images of at least 4x4.
+    Otherwise OpenCV's cubic path rounds differently to a single image (off
+    by one grey level on occasion).
+
+    Everything else, including nearest, area and Lanczos, is resized image by
+    image straight into its slice of the output stack, which measured quicker
+    than the tall image for larger images
+
+    Params
+    ------
+    stack : <numpy array> (N, H, W[, C])
+    fx : <float> horizontal scale
+    fy : <float> vertical scale
+    interpolation : <int> OpenCV interpolation flag
+
+    Returns
+    -------
+    <numpy array> (N, H', W'[, C])
+
+    """
+    if interpolation == cv2.INTER_CUBIC:
+        batched = float(fx).is_integer() and \
+            min(stack.shape[1], stack.shape[2]) >= 4
+    else:
+        batched = interpolation == cv2.INTER_LINEAR
+    batched = batched and float(fy).is_integer() and fy >= 1 and \
+        stack.shape[1] * stack.shape[2] <= BATCH_RESIZE_MAX_PIXELS
+    if batched:
+        fy = int(fy)
+        pad = 4
+        height = stack.shape[1]
+        pad_width = ((0, 0), (pad, pad)) + ((0, 0),) * (stack.ndim - 2)
+        padded = np.pad(stack, pad_width, mode="edge")
+        tall = cv2.resize(_batch_rows(padded), None, fx=fx, fy=fy,
+                          interpolation=interpolation)
+        tall = tall.reshape((stack.shape[0], (height + 2*pad) * fy) +
+                            tall.shape[1:])
+        return np.ascontiguousarray(tall[:, pad*fy:(pad+height)*fy])
+
+    first = cv2.resize(stack[0], None, fx=fx, fy=fy,
+                       interpolation=interpolation)
+    rtn = np.empty((stack.shape[0],) + first.shape, first.dtype)
+    rtn[0] = first
+    # dsize left unset, as it would override fx and fy
+    for img, out in zip(stack[1:], rtn[1:]):
+        cv2.resize(img, None, dst=out, fx=fx, fy=fy,
+                   interpolation=interpolation)
+    return rtn
+
+
+# -----------------------------------------------------------------------------
+def _batch_otsu(stack, invert=False):
+    """
+    Otsu threshold a greyscale uint8 stack, each image with its own threshold
+
+    Not a batched call, as the threshold is searched per image: each image
+    is thresholded by OpenCV directly into its slice of the output stack. A
+    vectorised Otsu search over the stack's histograms was tried and is some
+    10x slower than OpenCV's per image
+
+    Params
+    ------
+    stack : <numpy array> (N, H, W) uint8
+    invert : <bool> Binarise as THRESH_BINARY_INV, i.e. white background
+
+    Returns
+    -------
+    <numpy array> (N, H, W) uint8 of 0 or 255
+
+    """
+    flags = (cv2.THRESH_BINARY_INV if invert else cv2.THRESH_BINARY) + \
+        cv2.THRESH_OTSU
+    rtn = np.empty(stack.shape, np.uint8)
+    for img, out in zip(stack, rtn):
+        cv2.threshold(img, 0, 255, flags, dst=out)
+    return rtn
+
+
+# -----------------------------------------------------------------------------
 class ImageManipulation:
     """
     Class containing image manipulation functions
 
     Use of **kwargs as inputs to all aligns with calling approach from
     field_manager, even if they are superfluous here
+
+    Passing "batch": True applies an operator to a stack of equal-shaped
+    images, (N, H, W) or (N, H, W, 3) as from stack_images, in a handful of
+    OpenCV calls for the whole stack rather than one per image. The Otsu
+    threshold, and resizes other than those listed in _batch_resize, still
+    run once per image
+
+    With a BufferPool given as "pool" (at instantiation or per call), single
+    image outputs are written into pooled buffers via OpenCV's dst= arguments
+    rather than freshly allocated
+
+    Images of at least tile_threshold pixels have their median blur, cubic
+    (or nearest) resize by a whole number fy, and morphology split into
+    overlapping row strips run across tile_workers threads, bit-exact with a
+    single call. OpenCV parallelises some of these internally, tiling mainly
+    pays where it doesn't (e.g. the larger median kernels) or when
+    cv2.setNumThreads has been limited
     """
 
     # -------------------------------------------------------------------------
@@ -33,16 +464,232 @@ class ImageManipulation:
         Params
         ------
         kwargs : <dict>
+            pool : <BufferPool> Optional pool for output buffers
+            tile_threshold : <int> pixel count from which images are tiled
+            tile_workers : <int> threads for tiling, 1 disables it
 
         Returns
         -------
         None
 
         """
+        self.pool = None
+        self.tile_threshold = 3840 * 2160 // 2
+        self.tile_workers = mp.cpu_count()
+
         # This will set all entries within kwargs into the class variable space
         for key_val in kwargs.items():
             setattr(self, key_val[0], key_val[1])
 
+    # -------------------------------------------------------------------------
+    def _output_buffer(self, kwargs, shape, dtype):
+        """
+        Output buffer from the pool, if one is in use
+
+        Params
+        ------
+        kwargs : <dict> operator kwargs, may carry "pool"
+        shape : <tuple> shape of the output
+        dtype : numpy dtype of the output
+
+        Returns
+        -------
+        <numpy array>, or None for OpenCV to allocate
+
+        """
+        pool = kwargs.get("pool", self.pool)
+        if pool is None or kwargs.get("batch"):
+            return None
+        return pool.acquire(shape, dtype)
+
+    # -------------------------------------------------------------------------
+    def _release_buffer(self, kwargs, buf):
+        """
+        Return a scratch buffer to the pool, if one is in use
+
+        Params
+        ------
+        kwargs : <dict> operator kwargs, may carry "pool"
+        buf : <numpy array>
+
+        Returns
+        -------
+        None
+
+        """
+        pool = kwargs.get("pool", self.pool)
+        if pool is not None:
+            pool.release(buf)
+
+    # -------------------------------------------------------------------------
+    def _tile_workers(self, kwargs, img):
+        """
+        Number of threads to tile an image across, 0 if it isn't to be tiled
+
+        Params
+        ------
+        kwargs : <dict> operator kwargs, may carry tile_threshold and
+            tile_workers
+        img : <image>
+
+        Returns
+        -------
+        <int>
+
+        """
+        n_workers = kwargs.get("tile_workers", self.tile_workers)
+        threshold = kwargs.get("tile_threshold", self.tile_threshold)
+        if kwargs.get("batch") or n_workers is None or int(n_workers) <= 1 \
+                or img.shape[0] * img.shape[1] < threshold:
+            return 0
+        return int(n_workers)
+
+    # -------------------------------------------------------------------------
+    def _median_blur(self, kwargs, img, ksize):
+        """
+        Median blur a single image, tiled if large
+
+        Params
+        ------
+        kwargs : <dict> operator kwargs
+        img : <image>
+        ksize : <int> odd kernel size
+
+        Returns
+        -------
+        <image> in a pooled buffer, if a pool is in use
+
+        """
+        dst = self._output_buffer(kwargs, img.shape, img.dtype)
+        n_workers = self._tile_workers(kwargs, img)
+        if not n_workers:
+            return cv2.medianBlur(img, ksize, dst=dst)
+
+        if dst is None:
+            dst = np.empty(img.shape, img.dtype)
+        return _tile_rows(img, lambda rows: cv2.medianBlur(rows, ksize),
+                          ksize // 2, dst, n_workers)
+
+    # -------------------------------------------------------------------------
+    def _morphology(self, kwargs, img, func, radius):
+        """
+        Erode/dilate a single image, tiled if large
+
+        Params
+        ------
+        kwargs : <dict> operator kwargs
+        img : <image>
+        func : <callable> taking and returning an image
+        radius : <int> vertical reach of the kernel over all iterations
+
+        Returns
+        -------
+        <image> in a pooled buffer, if a pool is in use
+
+        """
+        dst = self._output_buffer(kwargs, img.shape, img.dtype)
+        n_workers = self._tile_workers(kwargs, img)
+        if not n_workers:
+            return func(img, dst)
+
+        if dst is None:
+            dst = np.empty(img.shape, img.dtype)
+        return _tile_rows(img, lambda rows: func(rows, None), radius, dst,
+                          n_workers)
+
+    # -------------------------------------------------------------------------
+    def adaptive_resize(self, **kwargs):
+        """
+        Resize the image so its text glyphs reach TEXT_GLYPH_HEIGHT
+
+        The scale is estimated from the connected components of the image,
+        large text is returned untouched rather than upscaled
+
+        Params
+        ------
+        kwargs : <dict>
+            MinHeight : <float> target glyph height in pixels
+            MaxScale : <float> upper limit on the scale (default 8)
+            interpolation : OpenCV interpolation flag, as resize
+
+        Returns
+        -------
+        <image>
+
+        """
+        if "img" in kwargs:
+            img = kwargs["img"]
+        else:
+            img = self.image
+
+        if "MinHeight" in kwargs:
+            min_height = float(kwargs["MinHeight"])
+        else:
+            min_height = TEXT_GLYPH_HEIGHT
+
+        if "MaxScale" in kwargs:
+            max_scale = float(kwargs["MaxScale"])
+        else:
+            max_scale = 8
+
+        scale = adaptive_scale(img, min_height, max_scale,
+                               kwargs.get("batch", False))
+        if scale == 1:
+            return img
+
+        kwargs1 = dict(kwargs)
+        kwargs1.update({"img": img, "fx": scale, "fy": scale})
+        return self.resize(**kwargs1)
+
+    # -------------------------------------------------------------------------
+    def crop_text(self, **kwargs):
+        """
+        Crop the image to the region containing text, plus padding
+
+        Intended to come before any upscaling, so the resize and OCR only pay
+        for the pixels around the text. The image is returned untouched if no
+        text is found. In batch mode every image is cropped to the union
+        region of the stack, so the stack keeps one shape
+
+        Params
+        ------
+        kwargs : <dict>
+            Padding : <int> pixels to pad the text region by (default 8)
+
+        Returns
+        -------
+        <image>
+
+        """
+        if "img" in kwargs:
+            img = kwargs["img"]
+        else:
+            img = self.image
+
+        if "Padding" in kwargs:
+            padding = int(kwargs["Padding"])
+        else:
+            padding = 8
+
+        box = text_bounding_box(img, padding, kwargs.get("batch", False))
+        if box is None:
+            return img
+        x0, y0, width, height = box
+        if kwargs.get("batch"):
+            return np.ascontiguousarray(
+                img[:, y0:y0+height, x0:x0+width])
+        if (height, width) == img.shape[:2]:
+            return img
+
+        # Copied out rather than a view, as the parent may be handed back to
+        # the buffer pool
+        crop = img[y0:y0+height, x0:x0+width]
+        dst = self._output_buffer(kwargs, crop.shape, crop.dtype)
+        if dst is None:
+            return crop.copy()
+        np.copyto(dst, crop)
+        return dst
+
     # -------------------------------------------------------------------------
     def dilate(self, **kwargs):
         """
@@ -66,8 +713,18 @@ class ImageManipulation:
             iterations = int(kwargs["iterations"])
         else:
             iterations = 1
-        kernel = np.ones((1, 1), np.uint8)
-        return cv2.dilate(img, kernel, iterations=iterations)
+        kernel = np.ones(MORPH_KERNEL, np.uint8)
+        radius = (kernel.shape[0] // 2) * iterations
+        if kwargs.get("batch"):
+            return _batch_morphology(
+                img,
+                lambda rows: cv2.dilate(rows, kernel, iterations=iterations),
+                radius, 0)
+        return self._morphology(
+            kwargs, img,
+            lambda rows, dst: cv2.dilate(rows, kernel, dst=dst,
+                                         iterations=iterations),
+            radius)
 
     # -------------------------------------------------------------------------
     def erode(self, **kwargs):
@@ -92,8 +749,82 @@ class ImageManipulation:
             iterations = int(kwargs["iterations"])
         else:
             iterations = 1
-        kernel = np.ones((1, 1), np.uint8)
-        return cv2.erode(img, kernel, iterations=iterations)
+        kernel = np.ones(MORPH_KERNEL, np.uint8)
+        radius = (kernel.shape[0] // 2) * iterations
+        if kwargs.get("batch"):
+            return _batch_morphology(
+                img,
+                lambda rows: cv2.erode(rows, kernel, iterations=iterations),
+                radius, 255)
+        return self._morphology(
+            kwargs, img,
+            lambda rows, dst: cv2.erode(rows, kernel, dst=dst,
+                                        iterations=iterations),
+            radius)
+
+    # -------------------------------------------------------------------------
+    def grey_blur_otsu(self, **kwargs):
+        """
+        Fused greyscale, optional median blur and Otsu threshold, optionally
+        inverted
+
+        Gives the same image as the greyscale -> threshold -> invert steps
+        (each optional bar the threshold), but with a single output buffer
+        that the blur writes into and the threshold then binarises in place.
+        The invert is folded into the threshold as THRESH_BINARY_INV, which is
+        the exact complement of THRESH_BINARY with a maxval of 255
+
+        Substituted for those chains by PlanCompiler, rather than written into
+        field files by hand
+
+        Params
+        ------
+        kwargs : <dict>
+            MedianBlur : odd kernel size, or "False" for no blur
+            Invert : <str> "True" to invert the thresholded image
+
+        Returns
+        -------
+        <image>
+
+        """
+        if "img" in kwargs:
+            img = kwargs["img"]
+        else:
+            img = self.image
+
+        batch = kwargs.get("batch", False)
+        pool = kwargs.get("pool", self.pool)
+        invert = kwargs.get("Invert", "False") == "True"
+        ksize = kwargs.get("MedianBlur", "False")
+        ksize = None if ksize == "False" else int(ksize)
+        flag = cv2.THRESH_BINARY_INV if invert else cv2.THRESH_BINARY
+
+        if img.ndim == (3 if batch else 2):
+            grey = img  # Already greyscale, skip the failed conversion
+        else:
+            grey = self.greyscale(**{"img": img, "batch": batch,
+                                     "pool": pool})
+
+        if batch:
+            if ksize is not None:
+                grey = _batch_median_blur(grey, ksize)
+            return _batch_otsu(grey, invert)
+
+        if ksize is not None:
+            rtn = self._median_blur(kwargs, grey, ksize)
+            if grey is not img:
+                self._release_buffer(kwargs, grey)
+        elif grey is not img:
+            rtn = grey  # Our own greyscale buffer
+        else:
+            rtn = self._output_buffer(kwargs, grey.shape, grey.dtype)
+            return cv2.threshold(grey, 0, 255, flag + cv2.THRESH_OTSU,
+                                 dst=rtn)[1]
+
+        # Otsu's histogram is taken before any pixel is written, so the
+        # threshold is safe in place
+        return cv2.threshold(rtn, 0, 255, flag + cv2.THRESH_OTSU, dst=rtn)[1]
 
     # -------------------------------------------------------------------------
     def greyscale(self, **kwargs):
@@ -114,8 +845,18 @@ class ImageManipulation:
         else:
             img = self.image
 
+        if img.ndim == (3 if kwargs.get("batch") else 2):
+            return img  # Already single channel, e.g. decoded greyscale
+
         try:
-            grey = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            if kwargs.get("batch"):
+                grey = cv2.cvtColor(_batch_rows(img), cv2.COLOR_BGR2GRAY)
+                grey = grey.reshape(img.shape[:3])
+            elif img.ndim == 3 and img.shape[2] == 3:
+                dst = self._output_buffer(kwargs, img.shape[:2], img.dtype)
+                grey = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=dst)
+            else:
+                grey = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         except Exception:
             print("Unable to perform greyscale on image")
             grey = img
@@ -140,7 +881,10 @@ class ImageManipulation:
         else:
             img = self.image
 
-        return cv2.bitwise_not(img)
+        if kwargs.get("batch"):
+            return cv2.bitwise_not(_batch_rows(img)).reshape(img.shape)
+        dst = self._output_buffer(kwargs, img.shape, img.dtype)
+        return cv2.bitwise_not(img, dst=dst)
 
     # -------------------------------------------------------------------------
     def resize(self, **kwargs):
@@ -173,12 +917,34 @@ class ImageManipulation:
 
         if "interpolation" in kwargs:
             interpolation = kwargs["interpolation"]
+        else:
+            interpolation = cv2.INTER_CUBIC
 
-            rtn = cv2.resize(img, None, fx=fx, fy=fy,
-                             interpolation=interpolation)
+        if kwargs.get("batch"):
+            rtn = _batch_resize(img, fx, fy, interpolation)
         else:
-            rtn = cv2.resize(img, None, fx=fx, fy=fy,
-                             interpolation=cv2.INTER_CUBIC)
+            # Same rounding of the output size as OpenCV, so the pooled
+            # buffer is used as is
+            shape = (int(round(img.shape[0] * fy)),
+                     int(round(img.shape[1] * fx))) + img.shape[2:]
+            dst = self._output_buffer(kwargs, shape, img.dtype)
+            n_workers = self._tile_workers(kwargs, img)
+            if n_workers and float(fy).is_integer() and fy >= 1 and \
+                    interpolation in (cv2.INTER_CUBIC, cv2.INTER_NEAREST):
+                # Whole number fy keeps every strip's row mapping in step
+                # with the whole image's. The cubic kernel reaches 2 rows,
+                # but OpenCV's IPP path reads further near a strip's edge,
+                # 4 rows keeps it exact
+                if dst is None:
+                    dst = np.empty(shape, img.dtype)
+                rtn = _tile_rows(
+                    img,
+                    lambda rows: cv2.resize(rows, None, fx=fx, fy=int(fy),
+                                            interpolation=interpolation),
+                    4, dst, n_workers, int(fy))
+            else:
+                rtn = cv2.resize(img, None, dst=dst, fx=fx, fy=fy,
+                                 interpolation=interpolation)
 
         return rtn
 
@@ -203,16 +969,35 @@ class ImageManipulation:
         else:
             img = self.image
 
-        img0 = self.greyscale(**{"img": img})
+        batch = kwargs.get("batch", False)
+        pool = kwargs.get("pool", self.pool)
+        img0 = self.greyscale(**{"img": img, "batch": batch, "pool": pool})
         if "MedianBlur" in kwargs and kwargs["MedianBlur"] != "False":
-            img0 = cv2.medianBlur(img0, int(kwargs["MedianBlur"]))
+            if batch:
+                img0 = _batch_median_blur(img0, int(kwargs["MedianBlur"]))
+            else:
+                blurred = self._median_blur(kwargs, img0,
+                                            int(kwargs["MedianBlur"]))
+                if img0 is not img:
+                    self._release_buffer(kwargs, img0)
+                img0 = blurred
 
         if "Binary_OTSU" in kwargs and kwargs["Binary_OTSU"] == "True":
-            rtn = cv2.threshold(img0, 0, 255,
-                                cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+            if batch:
+                rtn = _batch_otsu(img0)
+            else:
+                if img0 is img:
+                    dst = self._output_buffer(kwargs, img0.shape, img0.dtype)
+                else:
+                    dst = img0  # Our own scratch, threshold it in place
+                rtn = cv2.threshold(img0, 0, 255,
+                                    cv2.THRESH_BINARY + cv2.THRESH_OTSU,
+                                    dst=dst)[1]
         else:
             print("Unable to perform thresholding, invalid params, " +
                   "returning original image")
+            if img0 is not img:
+                self._release_buffer(kwargs, img0)
             rtn = img  # Just return raw image
         return rtn
 
@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of image manipulation operators and their metadata
+
+Each operator declares what it does to an image, so schedulers, caches and
+plan optimisers can reason about paths without running them:
+
+    in_channels   : channel counts the operator accepts
+    out_channels  : channel count produced, None if the same as the input
+    idempotent    : applying twice is the same as applying once
+    involution    : applying twice gives back the original image
+    releases_gil  : runs outside the GIL, so suits the threaded controller
+    cost          : relative cost, in units of one pass over a single channel
+                    pixel (invert of a greyscale image ~ 1 per pixel)
+
+The built-in operators are the public methods of ImageManipulation. Third
+party operators register a plain function taking the same kwargs as the
+built-ins (img plus the step params) and returning the image:
+
+    from operator_registry import register_operator
+    register_operator(**{"name": "deskew", "func": deskew,
+                         "in_channels": (1,), "cost_per_pixel": 8.0})
+
+after which "deskew" can be used as a foo in field files. Functions given to
+the SMP controller must be importable at module level, so they pickle.
+"""
+
+import numpy as np
+
+
+# -----------------------------------------------------------------------------
+def _otsu_cost(pixels, channels, params):
+    """
+    Cost of an Otsu threshold, dominated by any median blur
+
+    Params
+    ------
+    pixels : <int> input pixel count
+    channels : <int> input channel count
+    params : <dict> step params
+
+    Returns
+    -------
+    <float>
+
+    """
+    cost = 6.5 * pixels
+    if channels > 1:
+        cost += 4.5 * pixels  # Greyscale conversion
+    blur = params.get("MedianBlur", "False") if isinstance(params, dict) \
+        else "False"
+    if blur != "False":
+        # Small kernels use a sorting network, larger a histogram per pixel
+        cost += (3.0 if int(blur) <= 3 else 16.0) * pixels
+    return cost
+
+
+# -----------------------------------------------------------------------------
+def _adaptive_resize_cost(pixels, channels, params):
+    """
+    Cost of an adaptive resize, estimating the glyph height then resizing
+
+    The scale is only known once run, so the resize is costed at 2x
+
+    Params
+    ------
+    pixels : <int> input pixel count
+    channels : <int> input channel count
+    params : <dict> step params
+
+    Returns
+    -------
+    <float>
+
+    """
+    cost = 30.0 * pixels  # Otsu and connected components
+    if channels > 1:
+        cost += 4.5 * pixels  # Greyscale conversion
+    return cost + _resize_cost(pixels, channels, {})
+
+
+# -----------------------------------------------------------------------------
+def _crop_cost(pixels, channels, params):
+    """
+    Cost of finding the text region, the edge gradient and Otsu dominate
+
+    Params
+    ------
+    pixels : <int> input pixel count
+    channels : <int> input channel count
+    params : <dict> step params
+
+    Returns
+    -------
+    <float>
+
+    """
+    cost = 20.0 * pixels
+    if channels > 1:
+        cost += (4.5 + channels) * pixels  # Greyscale conversion and copy
+    return cost
+
+
+# -----------------------------------------------------------------------------
+def _resize_cost(pixels, channels, params):
+    """
+    Cost of a resize, which scales with the output pixel count
+
+    Params
+    ------
+    pixels : <int> input pixel count
+    channels : <int> input channel count
+    params : <dict> step params
+
+    Returns
+    -------
+    <float>
+
+    """
+    fx, fy = _resize_factors(params)
+    return 6.5 * pixels * fx * fy * channels
+
+
+# -----------------------------------------------------------------------------
+def _resize_factors(params):
+    """
+    Resize factors of a step, with the operator defaults
+
+    Params
+    ------
+    params : <dict> step params
+
+    Returns
+    -------
+    <tuple> of (fx, fy)
+
+    """
+    params = params if isinstance(params, dict) else {}
+    return float(params.get("fx", 2)), float(params.get("fy", 2))
+
+
+# -----------------------------------------------------------------------------
+class OperatorSpec:
+    """
+    Class describing a single operator
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>
+            name : <str> foo name used in field files
+            method : <str> ImageManipulation method implementing a built-in
+            func : <callable> implementation of a third party operator
+            in_channels : <tuple> accepted channel counts, None for any
+            out_channels : <int> channel count produced, None for the same
+                as the input
+            scales : <bool> output size is scaled by the fx/fy params
+            idempotent : <bool>
+            involution : <bool>
+            releases_gil : <bool>
+            cost_per_pixel : <float> relative cost per pixel per channel
+            cost_model : <callable> Optional (pixels, channels, params) to
+                relative cost, replaces cost_per_pixel
+
+        Returns
+        -------
+        None
+
+        """
+        self.name = None
+        self.method = None
+        self.func = None
+        self.in_channels = None
+        self.out_channels = None
+        self.scales = False
+        self.idempotent = False
+        self.involution = False
+        self.releases_gil = False
+        self.cost_per_pixel = 1.0
+        self.cost_model = None
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+    # -------------------------------------------------------------------------
+    def accepts(self, shape):
+        """
+        Whether the operator accepts an image of this shape
+
+        Params
+        ------
+        shape : <tuple> image shape, (H, W) or (H, W, C)
+
+        Returns
+        -------
+        <bool>
+
+        """
+        if self.in_channels is None:
+            return True
+        return _channels(shape) in self.in_channels
+
+    # -------------------------------------------------------------------------
+    def output_shape(self, shape, params=None):
+        """
+        Shape of the image the operator produces from one of this shape,
+        an upper bound for operators that crop and an estimate (at the
+        default 2x) for adaptive_resize
+
+        Params
+        ------
+        shape : <tuple> image shape, (H, W) or (H, W, C)
+        params : <dict> step params
+
+        Returns
+        -------
+        <tuple>
+
+        """
+        height, width = shape[:2]
+        if self.scales:
+            fx, fy = _resize_factors(params)
+            height, width = int(round(height * fy)), int(round(width * fx))
+
+        channels = _channels(shape) if self.out_channels is None \
+            else self.out_channels
+        if channels == 1:
+            return (height, width)
+        return (height, width, channels)
+
+    # -------------------------------------------------------------------------
+    def cost(self, shape, params=None):
+        """
+        Relative cost of running the operator on an image of this shape
+
+        Params
+        ------
+        shape : <tuple> image shape, (H, W) or (H, W, C)
+        params : <dict> step params
+
+        Returns
+        -------
+        <float>
+
+        """
+        pixels = int(np.prod(shape[:2]))
+        channels = _channels(shape)
+        if self.cost_model is not None:
+            return self.cost_model(pixels, channels, params)
+        return self.cost_per_pixel * pixels * channels
+
+    # -------------------------------------------------------------------------
+    def bind(self, manip):
+        """
+        Callable implementing the operator
+
+        Params
+        ------
+        manip : <ImageManipulation> instance providing the built-ins
+
+        Returns
+        -------
+        <callable>
+
+        """
+        if self.func is not None:
+            return self.func
+        return getattr(manip, self.method)
+
+
+# -----------------------------------------------------------------------------
+def _channels(shape):
+    """
+    Channel count of an image shape
+
+    Params
+    ------
+    shape : <tuple>
+
+    Returns
+    -------
+    <int>
+
+    """
+    return 1 if len(shape) == 2 else shape[2]
+
+
+# -----------------------------------------------------------------------------
+class OperatorRegistry:
+    """
+    Class holding the operators available to field files
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>   [not used, just retained for consistency elsewhere]
+
+        Returns
+        -------
+        None
+
+        """
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+        self.specs = {}
+
+    # -------------------------------------------------------------------------
+    def register(self, **kwargs):
+        """
+        Register an operator
+
+        Params
+        ------
+        kwargs : <dict> as OperatorSpec, plus
+            replace : <bool> Replace an operator of the same name
+
+        Returns
+        -------
+        <OperatorSpec>, or None if not registered
+
+        """
+        replace = kwargs.pop("replace", False)
+        spec = OperatorSpec(**kwargs)
+        if not spec.name or (spec.func is None and spec.method is None):
+            print("Unable to register operator, a name and a func or " +
+                  "method are required: " + str(spec.name))
+            return None
+        if spec.name in self.specs and not replace:
+            print("Operator already registered: " + spec.name +
+                  ", pass replace=True to replace it")
+            return None
+        self.specs[spec.name] = spec
+        return spec
+
+    # -------------------------------------------------------------------------
+    def unregister(self, name):
+        """
+        Remove an operator
+
+        Params
+        ------
+        name : <str>
+
+        Returns
+        -------
+        None
+
+        """
+        self.specs.pop(name, None)
+
+    # -------------------------------------------------------------------------
+    def get(self, name):
+        """
+        Spec of an operator
+
+        Params
+        ------
+        name : <str>
+
+        Returns
+        -------
+        <OperatorSpec>, or None if not registered
+
+        """
+        return self.specs.get(name)
+
+    # -------------------------------------------------------------------------
+    def names(self):
+        """
+        Names of the registered operators
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <list>
+
+        """
+        return sorted(self.specs)
+
+    # -------------------------------------------------------------------------
+    def operators(self, manip):
+        """
+        Callables of all registered operators
+
+        Params
+        ------
+        manip : <ImageManipulation> instance providing the built-ins
+
+        Returns
+        -------
+        <dict> of name to callable
+
+        """
+        return {name: spec.bind(manip) for name, spec in self.specs.items()}
+
+    # -------------------------------------------------------------------------
+    def path_cost(self, path_data, shape):
+        """
+        Relative cost of a path of steps on an image of this shape
+
+        Params
+        ------
+        path_data : <list> of steps
+        shape : <tuple> input image shape
+
+        Returns
+        -------
+        <float>, None if the path has an unregistered operator
+
+        """
+        total = 0.0
+        for step in path_data:
+            spec = self.get(step["foo"])
+            if spec is None:
+                return None
+            total += spec.cost(shape, step.get("params"))
+            shape = spec.output_shape(shape, step.get("params"))
+        return total
+
+
+# -----------------------------------------------------------------------------
+# Built-in operators, costs measured against invert on a 1920x1080 greyscale
+REGISTRY = OperatorRegistry()
+for _spec in (
+        {"name": "adaptive_resize", "method": "adaptive_resize",
+         "scales": True, "cost_model": _adaptive_resize_cost},
+        {"name": "crop_text", "method": "crop_text",
+         "cost_model": _crop_cost},
+        {"name": "dilate", "method": "dilate", "cost_per_pixel": 1.0},
+        {"name": "erode", "method": "erode", "cost_per_pixel": 1.0},
+        {"name": "grey_blur_otsu", "method": "grey_blur_otsu",
+         "out_channels": 1, "in_channels": (1, 3, 4),
+         "cost_model": _otsu_cost},
+        {"name": "greyscale", "method": "greyscale", "out_channels": 1,
+         "in_channels": (1, 3, 4), "idempotent": True,
+         "cost_per_pixel": 1.5},
+        {"name": "invert", "method": "invert", "involution": True,
+         "cost_per_pixel": 1.0},
+        {"name": "resize", "method": "resize", "scales": True,
+         "cost_model": _resize_cost},
+        {"name": "threshold", "method": "threshold", "out_channels": 1,
+         "in_channels": (1, 3, 4), "cost_model": _otsu_cost},
+        ):
+    REGISTRY.register(**{"releases_gil": True, **_spec})
+
+
+# -----------------------------------------------------------------------------
+def register_operator(**kwargs):
+    """
+    Register an operator with the shared registry
+
+    Params
+    ------
+    kwargs : <dict> as OperatorRegistry.register
+
+    Returns
+    -------
+    <OperatorSpec>, or None if not registered
+
+    """
+    return REGISTRY.register(**kwargs)
+
+
+# -----------------------------------------------------------------------------
+# ---- main
+if __name__ == "__main__":
+    for name in REGISTRY.names():
+        spec = REGISTRY.get(name)
+        print(name + ": in " + str(spec.in_channels) +
+              ", out " + str(spec.out_channels) +
+              ", idempotent " + str(spec.idempotent) +
+              ", involution " + str(spec.involution) +
+              ", releases GIL " + str(spec.releases_gil) +
+              ", cost on 1080p BGR " +
+              str(round(spec.cost((1080, 1920, 3)) / 1e6, 1)) + "M")
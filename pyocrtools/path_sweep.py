@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Expansion of parameter sweeps within a field file
+
+A step's params may contain sweep entries rather than single values:
+
+    list  : "fx": [2, 3, 4]
+    range : "MedianBlur": {"range": [3, 7, 2]}   (start, stop, step - the
+            stop value is inclusive, step defaults to 1)
+
+A path containing sweep entries is expanded into the cartesian set of
+concrete paths, e.g. resize fx 2/3/4 x threshold MedianBlur 3/5 gives six
+paths. Expansion is lazy, concrete paths are only built as they are consumed.
+
+sweep_cap bounds the concrete paths of the whole field, not of each path: the
+sample is drawn once across the grids of all its swept paths, so a field of
+many swept paths still yields at most sweep_cap of them. Paths without sweep
+entries are always kept and don't count towards the cap.
+"""
+
+from itertools import product
+
+import random
+import zlib
+
+
+class PathSweep:
+    """
+    Class for expanding the paths of a field into concrete paths
+
+    Paths without any sweep entries are passed through untouched
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>
+            paths : <dict> of path name to list of steps, as per field file
+            sweep_cap : <int> Optional maximum number of concrete paths
+                across the swept paths of the field. Grids larger than this
+                are sampled randomly
+            sweep_seed : <int> Optional seed for the random sampling
+
+        Returns
+        -------
+        None
+
+        """
+        self.sweep_cap = None
+        self.sweep_seed = None
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+    # -------------------------------------------------------------------------
+    def expand(self):
+        """
+        Lazily expand all paths
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <generator> of (path name, list of steps) tuples
+
+        """
+        swept = []
+        grid_total = 0
+        for path_name, path_data in self.paths.items():
+            axes = self.sweep_axes(path_data)
+            grid_size = self.grid_size(axes)
+            swept.append((path_name, path_data, axes, grid_total))
+            grid_total += grid_size
+
+        if self.sweep_cap is None or grid_total <= int(self.sweep_cap):
+            for path_name, path_data, axes, _ in swept:
+                yield from self.expand_path(path_name, path_data, axes=axes)
+            return
+
+        # One sample of flat indices across the concatenated grids of the
+        # field, this never materialises any grid
+        rng = random.Random(self.sweep_seed)
+        indices = sorted(rng.sample(range(grid_total), int(self.sweep_cap)))
+        for path_name, path_data, axes, offset in swept:
+            if not axes:
+                yield path_name, path_data
+                continue
+            end = offset + self.grid_size(axes)
+            path_indices = [index - offset for index in indices
+                            if offset <= index < end]
+            yield from self.expand_path(path_name, path_data, axes=axes,
+                                        indices=path_indices)
+
+    # -------------------------------------------------------------------------
+    def expand_path(self, path_name, path_data, axes=None, indices=None):
+        """
+        Lazily expand a single path into its concrete paths
+
+        On its own, sweep_cap applies to this path, sampled with a seed
+        derived from sweep_seed and the path name so paths of the same grid
+        shape don't all sample the same grid points
+
+        Params
+        ------
+        path_name : <str> Name of the path in the field file
+        path_data : <list> of steps
+        axes : <list> Optional sweep axes, as sweep_axes
+        indices : <list> Optional flat grid indices to expand, overriding
+            sweep_cap
+
+        Returns
+        -------
+        <generator> of (path name, list of steps) tuples
+
+        """
+        if axes is None:
+            axes = self.sweep_axes(path_data)
+        if not axes:
+            yield path_name, path_data
+            return
+
+        grid_size = self.grid_size(axes)
+        if indices is None and self.sweep_cap is not None and \
+                grid_size > int(self.sweep_cap):
+            # Sample flat grid indices, this never materialises the grid
+            seed = None if self.sweep_seed is None else \
+                int(self.sweep_seed) + zlib.crc32(path_name.encode("utf-8"))
+            rng = random.Random(seed)
+            indices = sorted(rng.sample(range(grid_size), int(self.sweep_cap)))
+
+        if indices is not None:
+            combos = (self.grid_point(axes, index) for index in indices)
+        else:
+            combos = product(*[axis[2] for axis in axes])
+
+        for combo in combos:
+            steps = [dict(step) for step in path_data]
+            labels = []
+            for axis, value in zip(axes, combo):
+                i_step, param = axis[0], axis[1]
+                steps[i_step]["params"] = dict(steps[i_step]["params"])
+                steps[i_step]["params"][param] = value
+                labels.append(steps[i_step]["foo"] + "." + param + "=" +
+                              str(value))
+            yield path_name + "[" + ",".join(labels) + "]", steps
+
+    # -------------------------------------------------------------------------
+    def sweep_axes(self, path_data):
+        """
+        Gather the swept params within a path
+
+        Params
+        ------
+        path_data : <list> of steps
+
+        Returns
+        -------
+        <list> of (step index, param name, list of values) tuples
+
+        """
+        axes = []
+        for i_step, step in enumerate(path_data):
+            params = step.get("params")
+            if not isinstance(params, dict):
+                continue
+            for param, value in params.items():
+                values = self.sweep_values(value)
+                if values is not None:
+                    axes.append((i_step, param, values))
+        return axes
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def sweep_values(value):
+        """
+        Resolve a param value into its list of sweep values
+
+        Params
+        ------
+        value : param value from the field file
+
+        Returns
+        -------
+        <list> of values, or None if the value is not a sweep
+
+        """
+        if isinstance(value, list):
+            return value
+
+        if isinstance(value, dict) and "range" in value:
+            bounds = value["range"]
+            start, stop = bounds[0], bounds[1]
+            step = bounds[2] if len(bounds) > 2 else 1
+            if step <= 0:
+                print("Invalid sweep range step: " + str(step) +
+                      ", using start value only")
+                return [start]
+
+            values = []
+            i_value = 0
+            current = start
+            # Small tolerance so float ranges such as 1.5 to 2.5 in 0.5 keep
+            # their inclusive stop
+            while current <= stop + 1e-9 * abs(step):
+                values.append(current)
+                i_value += 1
+                current = start + i_value * step
+            return values
+
+        return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def grid_size(axes):
+        """
+        Number of points in the cartesian grid of a path's sweep axes
+
+        Params
+        ------
+        axes : <list> of (step index, param name, list of values) tuples
+
+        Returns
+        -------
+        <int>, 0 for a path without sweeps
+
+        """
+        if not axes:
+            return 0
+        grid_size = 1
+        for axis in axes:
+            grid_size *= len(axis[2])
+        return grid_size
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def grid_point(axes, index):
+        """
+        Decode a flat grid index into its combination of values
+
+        Params
+        ------
+        axes : <list> of (step index, param name, list of values) tuples
+        index : <int> flat index into the cartesian grid
+
+        Returns
+        -------
+        <tuple> of values, one per axis
+
+        """
+        combo = []
+        for axis in reversed(axes):
+            index, i_value = divmod(index, len(axis[2]))
+            combo.append(axis[2][i_value])
+        return tuple(reversed(combo))
@@ -0,0 +1,636 @@
+# -*- coding: utf-8 -*-
+"""
+Compilation of field file paths into cheaper, equivalent paths
+
+Paths are written in the field file as chains of simple steps. Each path is
+first simplified using the algebra declared in the operator registry, every
+rule giving a bit-exact image:
+
+    invert -> invert                   : removed (involution)
+    greyscale -> greyscale             : greyscale (idempotent)
+    greyscale of a greyscale image     : removed
+    greyscale -> threshold (Otsu)      : threshold (it greys internally)
+    threshold (not Otsu)               : removed (returns its input)
+    dilate/erode with a 1x1 kernel     : removed
+    resize with fx = fy = 1            : removed
+
+With approximate=True consecutive resizes are also merged into one. That
+interpolates once rather than twice, so is cheaper but not bit-exact.
+
+decode_hints works out how little of an image file the first field of a plan
+needs, so loaders can decode straight to greyscale when every path of it
+starts by greying the image, or at a reduced resolution when every path
+starts by downscaling (apply_decode_hints then takes the reduction out of
+those resizes). Neither is bit-exact against a full decode, libpng greys with
+its own weights and gamma handling, so they are opt-in.
+
+With crop_text=True a crop_text step is inserted before the first upscaling
+resize of a path, so the resize (and OCR) only pay for the text region.
+
+Common chains are then substituted with fused ImageManipulation operators that
+give a bit-exact image with fewer full-frame passes and intermediate buffers:
+
+    [greyscale ->] threshold (Otsu) [-> invert]   : grey_blur_otsu
+
+Compilation happens on concrete paths (after any parameter sweep has been
+expanded), path names are left untouched so results still read against the
+field file.
+"""
+
+from collections import Counter
+from pathlib import Path
+
+import copy
+import sys
+
+import cv2
+
+# My py
+from image_manipulation import MORPH_KERNEL
+from operator_registry import REGISTRY
+from path_sweep import PathSweep
+
+
+# Reduced decode flags by greyscale and reduction factor
+_IMREAD_FLAGS = {(False, 1): cv2.IMREAD_COLOR,
+                 (False, 2): cv2.IMREAD_REDUCED_COLOR_2,
+                 (False, 4): cv2.IMREAD_REDUCED_COLOR_4,
+                 (False, 8): cv2.IMREAD_REDUCED_COLOR_8,
+                 (True, 1): cv2.IMREAD_GRAYSCALE,
+                 (True, 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                 (True, 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                 (True, 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+                 }
+
+
+# -----------------------------------------------------------------------------
+class PlanCompiler:
+    """
+    Class for compiling the steps of a path
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>
+            fuse : <bool> Substitute fused operators (default True)
+            simplify : <bool> Apply the algebraic rules (default True)
+            approximate : <bool> Also apply rules that are not bit-exact,
+                i.e. merging consecutive resizes (default False)
+            crop_text : <bool> Crop to the text region before the first
+                upscale of each path (default False)
+            crop_padding : <int> Padding in pixels around the text region
+
+        Returns
+        -------
+        None
+
+        """
+        self.fuse = True
+        self.simplify = True
+        self.approximate = False
+        self.crop_text = False
+        self.crop_padding = 8
+        self.fusions = 0
+        self.crops_inserted = 0
+        self.steps_eliminated = 0
+        self.rules_applied = Counter()
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+    # -------------------------------------------------------------------------
+    def compile_fields(self, fields):
+        """
+        Compile every path of every field
+
+        Params
+        ------
+        fields : <dict> of field name to dict of path name to list of steps
+
+        Returns
+        -------
+        <dict> of the same form
+
+        """
+        return {field_name: {path_name: self.compile_path(path_data)
+                             for path_name, path_data in field_data.items()}
+                for field_name, field_data in fields.items()}
+
+    # -------------------------------------------------------------------------
+    def compile_path(self, path_data):
+        """
+        Compile the steps of a single path
+
+        Params
+        ------
+        path_data : <list> of steps
+
+        Returns
+        -------
+        <list> of steps, the input list is not modified
+
+        """
+        steps = list(path_data)
+        n_steps = len(steps)
+        if self.simplify:
+            steps = self.simplify_steps(steps)
+        if self.crop_text:
+            n_crops = self.crops_inserted
+            steps = self.insert_crop(steps)
+            n_steps += self.crops_inserted - n_crops
+        if self.fuse:
+            steps = self.fuse_otsu(steps)
+        self.steps_eliminated += n_steps - len(steps)
+        return steps
+
+    # -------------------------------------------------------------------------
+    def simplify_steps(self, steps):
+        """
+        Rewrite steps into an equivalent, shorter sequence
+
+        Works as a stack, so a rule that removes steps exposes the steps
+        either side of them to the rules in turn, e.g. invert -> dilate ->
+        invert simplifies away entirely
+
+        Params
+        ------
+        steps : <list> of steps
+
+        Returns
+        -------
+        <list> of steps
+
+        """
+        simplified = []
+        for step in steps:
+            if self.is_no_op(step):
+                self.rules_applied["no_op " + step["foo"]] += 1
+                continue
+
+            spec = REGISTRY.get(step["foo"])
+            prev = simplified[-1] if simplified else None
+            if prev is not None and spec is not None:
+                if prev["foo"] == step["foo"] and \
+                        prev.get("params") == step.get("params"):
+                    if spec.involution:
+                        simplified.pop()
+                        self.rules_applied["involution " + step["foo"]] += 1
+                        continue
+                    if spec.idempotent:
+                        self.rules_applied["idempotent " + step["foo"]] += 1
+                        continue
+
+                if step["foo"] == "greyscale" and self.is_greyscale(prev):
+                    self.rules_applied["greyscale of greyscale"] += 1
+                    continue
+
+                if prev["foo"] == "greyscale" and \
+                        (self.is_otsu_threshold(step) or
+                         step["foo"] == "grey_blur_otsu"):
+                    simplified.pop()
+                    self.rules_applied["greyscale before threshold"] += 1
+
+                if self.approximate and prev["foo"] == "resize" and \
+                        step["foo"] == "resize":
+                    merged = self.merge_resize(prev, step)
+                    if merged is not None:
+                        simplified[-1] = merged
+                        self.rules_applied["merge resize"] += 1
+                        continue
+
+            simplified.append(step)
+        return simplified
+
+    # -------------------------------------------------------------------------
+    def insert_crop(self, steps):
+        """
+        Insert a crop_text step before the first upscaling resize
+
+        Params
+        ------
+        steps : <list> of steps
+
+        Returns
+        -------
+        <list> of steps
+
+        """
+        if any(step["foo"] == "crop_text" for step in steps):
+            return steps
+
+        for i_step, step in enumerate(steps):
+            spec = REGISTRY.get(step["foo"])
+            if spec is None or not spec.scales:
+                continue
+            height, width = spec.output_shape((1000, 1000),
+                                              step.get("params"))
+            if height * width > 1000 * 1000:
+                self.crops_inserted += 1
+                crop = {"foo": "crop_text",
+                        "params": {"Padding": self.crop_padding}}
+                return steps[:i_step] + [crop] + steps[i_step:]
+        return steps
+
+    # -------------------------------------------------------------------------
+    def is_no_op(self, step):
+        """
+        Whether a step leaves the image unchanged
+
+        Params
+        ------
+        step : <dict>
+
+        Returns
+        -------
+        <bool>
+
+        """
+        params = step.get("params")
+        params = params if isinstance(params, dict) else {}
+        if step["foo"] == "threshold":
+            return not self.is_otsu_threshold(step)
+        if step["foo"] in ("dilate", "erode"):
+            return tuple(MORPH_KERNEL) == (1, 1)
+        if step["foo"] == "resize":
+            return float(params.get("fx", 2)) == 1 and \
+                float(params.get("fy", 2)) == 1
+        return False
+
+    # -------------------------------------------------------------------------
+    def is_greyscale(self, step):
+        """
+        Whether a step always produces a single channel image
+
+        Params
+        ------
+        step : <dict>
+
+        Returns
+        -------
+        <bool>
+
+        """
+        spec = REGISTRY.get(step["foo"])
+        if spec is None or spec.out_channels != 1:
+            return False
+        # Thresholds that aren't Otsu hand back their input, of any channels
+        return step["foo"] != "threshold" or self.is_otsu_threshold(step)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def merge_resize(first, second):
+        """
+        Merge two resize steps into one, multiplying their factors
+
+        Params
+        ------
+        first : <dict> resize step
+        second : <dict> resize step
+
+        Returns
+        -------
+        <dict> merged step, or None if the interpolations differ
+
+        """
+        params1 = first.get("params")
+        params1 = params1 if isinstance(params1, dict) else {}
+        params2 = second.get("params")
+        params2 = params2 if isinstance(params2, dict) else {}
+        if params1.get("interpolation") != params2.get("interpolation"):
+            return None
+
+        params = dict(params1)
+        params["fx"] = float(params1.get("fx", 2)) * float(params2.get("fx", 2))
+        params["fy"] = float(params1.get("fy", 2)) * float(params2.get("fy", 2))
+        return {"foo": "resize", "params": params}
+
+    # -------------------------------------------------------------------------
+    def fuse_otsu(self, steps):
+        """
+        Substitute grey_blur_otsu for greyscale/threshold/invert chains
+
+        Any greyscale steps directly before an Otsu threshold are absorbed
+        (the threshold converts to greyscale itself, so they change nothing),
+        as is a single invert directly after it
+
+        Params
+        ------
+        steps : <list> of steps
+
+        Returns
+        -------
+        <list> of steps
+
+        """
+        fused = []
+        i_step = 0
+        while i_step < len(steps):
+            step = steps[i_step]
+            if not self.is_otsu_threshold(step):
+                fused.append(step)
+                i_step += 1
+                continue
+
+            n_grey = 0
+            while fused and fused[-1]["foo"] == "greyscale":
+                fused.pop()
+                n_grey += 1
+
+            params = {"Invert": "False"}
+            blur = step["params"].get("MedianBlur", "False")
+            if blur != "False":
+                params["MedianBlur"] = blur
+
+            i_step += 1
+            if i_step < len(steps) and steps[i_step]["foo"] == "invert":
+                params["Invert"] = "True"
+                i_step += 1
+
+            fused.append({"foo": "grey_blur_otsu", "params": params})
+            self.fusions += 1
+        return fused
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def is_otsu_threshold(step):
+        """
+        Whether a step is a threshold that will apply Otsu binarisation
+
+        Thresholds with other params return the image untouched, so are left
+        alone
+
+        Params
+        ------
+        step : <dict>
+
+        Returns
+        -------
+        <bool>
+
+        """
+        params = step.get("params")
+        return step["foo"] == "threshold" and isinstance(params, dict) and \
+            params.get("Binary_OTSU") == "True"
+
+    # -------------------------------------------------------------------------
+    def decode_hints(self, fields):
+        """
+        How far the image files walked through a plan may be reduced at
+        decode, from the leading steps of the first field's paths
+
+        Greyscale when every concrete path (sweeps expanded) starts with a
+        step producing a single channel. Reduced by 2, 4 or 8 when every path
+        starts, after any greyscale step, with a resize by fx = fy not
+        exceeding the inverse of the reduction
+
+        Params
+        ------
+        fields : <dict> of field name to dict of path name to list of steps
+
+        Returns
+        -------
+        <dict> of
+            greyscale : <bool>
+            reduce : <int> 1, 2, 4 or 8
+            imread_flags : <int> cv2.IMREAD_* flags for the decode
+
+        """
+        first_field = next(iter(fields.values()), None) if fields else None
+        greyscale = bool(first_field)
+        reduce = 8 if first_field else 1
+        if first_field:
+            for _, steps in PathSweep(**{"paths": first_field}).expand():
+                steps = [step for step in steps if not self.is_no_op(step)]
+                if not steps or not self.is_greyscale(steps[0]):
+                    greyscale = False
+                    break
+
+            for steps in first_field.values():
+                i_resize = self.leading_resize(steps)
+                if i_resize is None:
+                    reduce = 1
+                    break
+                factor = float(steps[i_resize]["params"]["fx"])
+                while reduce > 1 and factor * reduce > 1:
+                    reduce //= 2
+
+        return {"greyscale": greyscale,
+                "reduce": reduce,
+                "imread_flags": _IMREAD_FLAGS[(greyscale, reduce)],
+                }
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def leading_resize(steps):
+        """
+        Index of a downscaling resize leading a path as written, after any
+        greyscale step, with fx = fy given as numbers rather than sweeps
+
+        Params
+        ------
+        steps : <list> of steps
+
+        Returns
+        -------
+        <int>, None if the path doesn't lead with one
+
+        """
+        i_step = 1 if steps and steps[0]["foo"] == "greyscale" else 0
+        if i_step >= len(steps) or steps[i_step]["foo"] != "resize":
+            return None
+        params = steps[i_step].get("params")
+        if not isinstance(params, dict):
+            return None
+        try:
+            fx, fy = float(params["fx"]), float(params["fy"])
+        except (KeyError, TypeError, ValueError):
+            return None  # Defaults upscale, or swept
+        if fx != fy or fx >= 1:
+            return None
+        return i_step
+
+    # -------------------------------------------------------------------------
+    def apply_decode_hints(self, fields, hints):
+        """
+        Adjust a plan for images decoded as per decode_hints, dropping the
+        leading greyscale steps of the first field when decoded greyscale and
+        taking the decode reduction out of its leading resizes
+
+        Params
+        ------
+        fields : <dict> of field name to dict of path name to list of steps
+        hints : <dict> as decode_hints
+
+        Returns
+        -------
+        <dict> of the same form, the input is not modified
+
+        """
+        fields = copy.deepcopy(fields)
+        if not fields:
+            return fields
+
+        first_field = next(iter(fields.values()))
+        for steps in first_field.values():
+            if hints["greyscale"]:
+                # Already single channel
+                while steps and steps[0]["foo"] == "greyscale":
+                    steps.pop(0)
+            if hints["reduce"] > 1:
+                params = steps[self.leading_resize(steps)]["params"]
+                for axis in ("fx", "fy"):
+                    params[axis] = float(params[axis]) * hints["reduce"]
+        return fields
+
+    # -------------------------------------------------------------------------
+    def return_data(self, attr):
+        """
+        Return the data 'attr' within the class
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        if hasattr(self, attr):
+            rtn = getattr(self, attr)
+        else:
+            print("Cannot find attribute: " + str(attr) + " to return")
+            rtn = None
+        return rtn
+
+
+# -----------------------------------------------------------------------------
+# ---- main
+if __name__ == "__main__":
+    # Check the compiled paths of a field file, plus chains exercising each
+    # rule and random chains, give bit-exact images against the paths as
+    # written, on the sample images
+    import random
+
+    import numpy as np
+
+    from image_acquisition import AcquireImage
+    from image_manipulation import ImageManipulation
+    from json5_reader import Json5Reader
+
+    cwd = Path.cwd()
+    field_file = sys.argv[1] if len(sys.argv) > 1 else \
+        str(cwd / "field_file.json5")
+    fields = Json5Reader(**{"filePath": field_file}).read_json()
+    fields["chains"] = {
+        "grey_blur_otsu": [{"foo": "greyscale", "params": "None"},
+                           {"foo": "threshold",
+                            "params": {"Binary_OTSU": "True",
+                                       "MedianBlur": "3"}}],
+        "otsu_invert": [{"foo": "threshold",
+                         "params": {"Binary_OTSU": "True"}},
+                        {"foo": "invert", "params": "None"}],
+        "double_invert": [{"foo": "invert", "params": "None"},
+                          {"foo": "dilate", "params": {"iterations": 2}},
+                          {"foo": "invert", "params": "None"}],
+        "repeated_greyscale": [{"foo": "greyscale", "params": "None"},
+                               {"foo": "greyscale", "params": "None"},
+                               {"foo": "resize", "params": {"fx": 1,
+                                                            "fy": 1}},
+                               {"foo": "greyscale", "params": "None"}],
+        "no_op_threshold": [{"foo": "threshold",
+                             "params": {"MedianBlur": "3"}},
+                            {"foo": "erode", "params": "None"}],
+        }
+    choices = [{"foo": "dilate", "params": "None"},
+               {"foo": "erode", "params": {"iterations": 2}},
+               {"foo": "greyscale", "params": "None"},
+               {"foo": "invert", "params": "None"},
+               {"foo": "resize", "params": {"fx": 1, "fy": 1}},
+               {"foo": "resize", "params": {"fx": 1.5, "fy": 2}},
+               {"foo": "threshold", "params": {"Binary_OTSU": "True"}},
+               {"foo": "threshold", "params": {"Binary_OTSU": "True",
+                                               "MedianBlur": "3"}},
+               {"foo": "threshold", "params": {"MedianBlur": "5"}},
+               ]
+    rng = random.Random(0)
+    fields["random"] = {"random" + str(i_path):
+                        [rng.choice(choices)
+                         for _ in range(rng.randint(1, 6))]
+                        for i_path in range(60)}
+
+    manip = ImageManipulation()
+    compiler = PlanCompiler()
+
+    def run(steps, img):
+        for step in steps:
+            params = step["params"] if isinstance(step["params"], dict) \
+                else {}
+            img = getattr(manip, step["foo"])(**{"img": img, **params})
+        return img
+
+    n_checked = 0
+    for image_file in sorted((cwd.parent / "tests" /
+                              "supportingdata").glob("*.png")):
+        img = AcquireImage(**{"ImageFile": str(image_file)}).open_image()
+        for field_name, field_data in fields.items():
+            for path_name, path_data in field_data.items():
+                if any(not hasattr(manip, step["foo"])
+                       for step in path_data):
+                    continue
+                compiled = compiler.compile_path(path_data)
+                if not np.array_equal(run(path_data, img),
+                                      run(compiled, img)):
+                    print("Mismatch: " + image_file.name + " " +
+                          field_name + "/" + path_name)
+                n_checked += 1
+    print("Checked " + str(n_checked) + " paths, " +
+          str(compiler.return_data("steps_eliminated")) +
+          " steps eliminated, " + str(compiler.return_data("fusions")) +
+          " fusions")
+    for rule, count in sorted(compiler.return_data("rules_applied").items()):
+        print("    " + rule + ": " + str(count))
+
+    # Decode hints of the field file, and of a plan greying then halving
+    # every image, with the decode time and memory they save on a 4K capture
+    import tempfile
+    import time
+
+    print("Decode hints of " + Path(field_file).name + ": " +
+          str(compiler.decode_hints(
+              Json5Reader(**{"filePath": field_file}).read_json())))
+    plan = {"field1": {"otsu": [{"foo": "greyscale", "params": "None"},
+                                {"foo": "resize",
+                                 "params": {"fx": 0.5, "fy": 0.5}},
+                                {"foo": "threshold",
+                                 "params": {"Binary_OTSU": "True"}}],
+                       "blur": [{"foo": "greyscale", "params": "None"},
+                                {"foo": "resize",
+                                 "params": {"fx": 0.25, "fy": 0.25}},
+                                {"foo": "grey_blur_otsu",
+                                 "params": {"MedianBlur": "3"}}]}}
+    hints = compiler.decode_hints(plan)
+    print("Decode hints of a greyscale, halving plan: " + str(hints))
+    print("    adjusted to: " +
+          str(compiler.apply_decode_hints(plan, hints)["field1"]["otsu"]))
+
+    capture = cv2.resize(img, (3840, 2160), interpolation=cv2.INTER_CUBIC)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for suffix in (".png", ".jpg"):
+            capture_file = str(Path(tmp_dir) / ("capture" + suffix))
+            cv2.imwrite(capture_file, capture)
+            for name, flags in (("full", cv2.IMREAD_COLOR),
+                                ("hinted", hints["imread_flags"])):
+                start = time.perf_counter()
+                for _ in range(5):
+                    decoded = cv2.imread(capture_file, flags)
+                print("    " + suffix + " " + name + " decode: " +
+                      str(round((time.perf_counter() - start) * 200, 1)) +
+                      " ms, " + str(decoded.nbytes // 1024) + " kB")
@@ -0,0 +1,575 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent screen capture session over X11 MIT-SHM
+
+pyscreeze sets up a fresh grab per screenshot, which dominates when polling a
+region at 10+ captures per second. A ScreenSession keeps the X connection and
+a shared memory segment sized to the screen open, so each grab is a single
+XShmGetImage into memory this process already maps, handed back as a NumPy
+view without copying.
+
+Only X11 with the MIT-SHM extension and a 24/32 bit TrueColor visual is
+supported (including Xvfb, so the session can be tested headlessly with
+xvfb-run). Anywhere else, e.g. Windows, macOS, Wayland or a remote display,
+the session falls back to pyscreeze, and "backend" reports which is in use.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+import pyscreeze
+
+# My py
+from image_acquisition import pil_to_bgr
+from trace_events import trace_span
+
+
+_ZPIXMAP = 2
+_ALL_PLANES = ctypes.c_ulong(-1).value
+_IPC_PRIVATE = 0
+_IPC_CREAT = 0o1000
+_IPC_RMID = 0
+
+
+# -----------------------------------------------------------------------------
+class _XImage(ctypes.Structure):
+    """
+    Xlib XImage, up to and including the function table
+    """
+    _fields_ = [("width", ctypes.c_int),
+                ("height", ctypes.c_int),
+                ("xoffset", ctypes.c_int),
+                ("format", ctypes.c_int),
+                ("data", ctypes.c_void_p),
+                ("byte_order", ctypes.c_int),
+                ("bitmap_unit", ctypes.c_int),
+                ("bitmap_bit_order", ctypes.c_int),
+                ("bitmap_pad", ctypes.c_int),
+                ("depth", ctypes.c_int),
+                ("bytes_per_line", ctypes.c_int),
+                ("bits_per_pixel", ctypes.c_int),
+                ("red_mask", ctypes.c_ulong),
+                ("green_mask", ctypes.c_ulong),
+                ("blue_mask", ctypes.c_ulong),
+                ("obdata", ctypes.c_void_p),
+                ("funcs", ctypes.c_void_p * 6),
+                ]
+
+
+# -----------------------------------------------------------------------------
+class _XShmSegmentInfo(ctypes.Structure):
+    """
+    XShm XShmSegmentInfo
+    """
+    _fields_ = [("shmseg", ctypes.c_ulong),
+                ("shmid", ctypes.c_int),
+                ("shmaddr", ctypes.c_void_p),
+                ("readOnly", ctypes.c_int),
+                ]
+
+
+# -----------------------------------------------------------------------------
+class _XErrorEvent(ctypes.Structure):
+    """
+    Xlib XErrorEvent
+    """
+    _fields_ = [("type", ctypes.c_int),
+                ("display", ctypes.c_void_p),
+                ("resourceid", ctypes.c_ulong),
+                ("serial", ctypes.c_ulong),
+                ("error_code", ctypes.c_ubyte),
+                ("request_code", ctypes.c_ubyte),
+                ("minor_code", ctypes.c_ubyte),
+                ]
+
+
+_X_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p,
+                                    ctypes.POINTER(_XErrorEvent))
+
+# Count of X errors and the (error code, request code) of the last, the event
+# itself is only valid during the handler call
+_x_errors = {"count": 0, "last": None}
+
+# Sessions relying on the handler, and the handler it replaced, which is
+# reinstated when the last of them closes
+_x_handler_users = 0
+_x_handler_previous = None
+_x_handler_lock = threading.Lock()
+
+
+# -----------------------------------------------------------------------------
+@_X_ERROR_HANDLER
+def _on_x_error(disp, event):
+    """
+    Record an X error, Xlib's default handler terminates the process
+
+    Params
+    ------
+    disp : <c_void_p> display
+    event : <POINTER(_XErrorEvent)>
+
+    Returns
+    -------
+    <int>
+
+    """
+    _x_errors["count"] += 1
+    _x_errors["last"] = (event.contents.error_code,
+                         event.contents.request_code)
+    return 0
+
+
+# -----------------------------------------------------------------------------
+def _install_x_error_handler(xlib):
+    """
+    Install _on_x_error as Xlib's process wide error handler, saving the
+    handler it replaces on first install
+
+    Params
+    ------
+    xlib : ctypes Xlib
+
+    Returns
+    -------
+    None
+
+    """
+    global _x_handler_users, _x_handler_previous
+    with _x_handler_lock:
+        if _x_handler_users == 0:
+            _x_handler_previous = xlib.XSetErrorHandler(
+                ctypes.cast(_on_x_error, ctypes.c_void_p))
+        _x_handler_users += 1
+
+
+# -----------------------------------------------------------------------------
+def _uninstall_x_error_handler(xlib):
+    """
+    Reinstate the handler replaced by _on_x_error, once no session needs it
+
+    Params
+    ------
+    xlib : ctypes Xlib
+
+    Returns
+    -------
+    None
+
+    """
+    global _x_handler_users, _x_handler_previous
+    with _x_handler_lock:
+        _x_handler_users -= 1
+        if _x_handler_users == 0:
+            xlib.XSetErrorHandler(_x_handler_previous)
+            _x_handler_previous = None
+
+
+# -----------------------------------------------------------------------------
+def _load_libraries():
+    """
+    Load Xlib, the X extension library and libc with their signatures
+
+    Params
+    ------
+    None
+
+    Returns
+    -------
+    <tuple> of (xlib, xext, libc) ctypes libraries
+
+    """
+    xlib = ctypes.cdll.LoadLibrary(ctypes.util.find_library("X11") or
+                                   "libX11.so.6")
+    xext = ctypes.cdll.LoadLibrary(ctypes.util.find_library("Xext") or
+                                   "libXext.so.6")
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+    disp = ctypes.c_void_p
+    for lib, name, argtypes, restype in (
+            (xlib, "XOpenDisplay", [ctypes.c_char_p], disp),
+            (xlib, "XCloseDisplay", [disp], ctypes.c_int),
+            (xlib, "XDefaultScreen", [disp], ctypes.c_int),
+            (xlib, "XRootWindow", [disp, ctypes.c_int], ctypes.c_ulong),
+            (xlib, "XDisplayWidth", [disp, ctypes.c_int], ctypes.c_int),
+            (xlib, "XDisplayHeight", [disp, ctypes.c_int], ctypes.c_int),
+            (xlib, "XDefaultVisual", [disp, ctypes.c_int], ctypes.c_void_p),
+            (xlib, "XDefaultDepth", [disp, ctypes.c_int], ctypes.c_int),
+            (xlib, "XSync", [disp, ctypes.c_int], ctypes.c_int),
+            (xlib, "XDestroyImage", [ctypes.POINTER(_XImage)],
+             ctypes.c_int),
+            (xlib, "XSetErrorHandler", [ctypes.c_void_p], ctypes.c_void_p),
+            (xext, "XShmQueryExtension", [disp], ctypes.c_int),
+            (xext, "XShmCreateImage",
+             [disp, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+              ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo),
+              ctypes.c_uint, ctypes.c_uint], ctypes.POINTER(_XImage)),
+            (xext, "XShmAttach", [disp, ctypes.POINTER(_XShmSegmentInfo)],
+             ctypes.c_int),
+            (xext, "XShmDetach", [disp, ctypes.POINTER(_XShmSegmentInfo)],
+             ctypes.c_int),
+            (xext, "XShmGetImage",
+             [disp, ctypes.c_ulong, ctypes.POINTER(_XImage), ctypes.c_int,
+              ctypes.c_int, ctypes.c_ulong], ctypes.c_int),
+            (libc, "shmget", [ctypes.c_int, ctypes.c_size_t, ctypes.c_int],
+             ctypes.c_int),
+            (libc, "shmat", [ctypes.c_int, ctypes.c_void_p, ctypes.c_int],
+             ctypes.c_void_p),
+            (libc, "shmdt", [ctypes.c_void_p], ctypes.c_int),
+            (libc, "shmctl", [ctypes.c_int, ctypes.c_int, ctypes.c_void_p],
+             ctypes.c_int),
+            ):
+        func = getattr(lib, name)
+        func.argtypes = argtypes
+        func.restype = restype
+    return xlib, xext, libc
+
+
+# -----------------------------------------------------------------------------
+class ScreenSession:
+    """
+    Class holding a screen capture session open between grabs
+
+    Thread safe, grabs are serialised on the one X connection
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class, opening the session
+
+        Params
+        ------
+        kwargs : <dict>
+            display : <str> Optional X display name, by default $DISPLAY
+            use_shm : <bool> Use MIT-SHM where available (default True),
+                False always uses pyscreeze
+
+        Returns
+        -------
+        None
+
+        """
+        self.display = None
+        self.use_shm = True
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+        self._lock = threading.RLock()
+        self._disp = None
+        self._shminfo = None
+        self._images = {}
+        self.backend = "pyscreeze"
+        self.size = None
+        self.grabs = 0
+
+        if self.use_shm and sys.platform.startswith("linux") and \
+                (self.display or os.environ.get("DISPLAY")):
+            try:
+                self.open_shm()
+            except Exception as err:
+                print("Unable to open an MIT-SHM capture session, falling " +
+                      "back to pyscreeze: " + str(err))
+                self.close()
+
+    # -------------------------------------------------------------------------
+    def open_shm(self):
+        """
+        Open the X connection and a shared memory segment sized to the screen
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        self._xlib, self._xext, self._libc = _load_libraries()
+        xlib, xext, libc = self._xlib, self._xext, self._libc
+
+        name = self.display.encode() if self.display else None
+        self._disp = xlib.XOpenDisplay(name)
+        if not self._disp:
+            raise OSError("cannot open display " + str(self.display or
+                                                        os.environ["DISPLAY"]))
+        if not xext.XShmQueryExtension(self._disp):
+            raise OSError("the display has no MIT-SHM extension")
+
+        screen = xlib.XDefaultScreen(self._disp)
+        self._root = xlib.XRootWindow(self._disp, screen)
+        self._visual = xlib.XDefaultVisual(self._disp, screen)
+        self._depth = xlib.XDefaultDepth(self._disp, screen)
+        if self._depth not in (24, 32):
+            raise OSError("unsupported screen depth " + str(self._depth))
+        self.size = (xlib.XDisplayWidth(self._disp, screen),
+                     xlib.XDisplayHeight(self._disp, screen))
+
+        # X errors default to terminating the process, record them instead
+        _install_x_error_handler(xlib)
+        self._x_handler = True
+
+        # One segment for the full screen, region grabs reuse its head
+        self._shminfo = _XShmSegmentInfo()
+        self._shminfo.shmid = -1
+        full = self.shm_image(*self.size)
+        n_bytes = full.contents.bytes_per_line * full.contents.height
+        self._shminfo.shmid = libc.shmget(_IPC_PRIVATE, n_bytes,
+                                          _IPC_CREAT | 0o600)
+        if self._shminfo.shmid < 0:
+            raise OSError("shmget failed, errno " + str(ctypes.get_errno()))
+        addr = libc.shmat(self._shminfo.shmid, None, 0)
+        if addr is None or addr == ctypes.c_void_p(-1).value:
+            raise OSError("shmat failed, errno " + str(ctypes.get_errno()))
+        self._shminfo.shmaddr = addr
+        self._shminfo.readOnly = 0
+        self._shm_bytes = n_bytes
+        full.contents.data = addr
+
+        n_errors = _x_errors["count"]
+        xext.XShmAttach(self._disp, ctypes.byref(self._shminfo))
+        xlib.XSync(self._disp, 0)
+        if _x_errors["count"] > n_errors:
+            raise OSError("XShmAttach failed (X error code, request code " +
+                          str(_x_errors["last"]) + "), is the display " +
+                          "remote?")
+        # Marked for removal now both ends are attached, so the segment
+        # can't outlive the process
+        libc.shmctl(self._shminfo.shmid, _IPC_RMID, None)
+        self._attached = True
+
+        image = full.contents
+        if image.bits_per_pixel != 32 or image.byte_order != 0 or \
+                image.red_mask != 0xFF0000 or image.blue_mask != 0xFF:
+            raise OSError("unsupported pixel layout, " +
+                          str(image.bits_per_pixel) + " bits per pixel")
+        self.backend = "shm"
+
+    # -------------------------------------------------------------------------
+    def shm_image(self, width, height):
+        """
+        XImage over the shared memory segment for grabs of this size
+
+        Params
+        ------
+        width : <int>
+        height : <int>
+
+        Returns
+        -------
+        <ctypes pointer> to the XImage
+
+        """
+        key = (width, height)
+        if key not in self._images:
+            image = self._xext.XShmCreateImage(
+                self._disp, self._visual, self._depth, _ZPIXMAP, None,
+                ctypes.byref(self._shminfo), width, height)
+            if not image:
+                raise OSError("XShmCreateImage failed for " + str(key))
+            if self._shminfo.shmaddr:
+                image.contents.data = self._shminfo.shmaddr
+            self._images[key] = image
+        return self._images[key]
+
+    # -------------------------------------------------------------------------
+    def grab(self, region=None):
+        """
+        Capture the screen, or a region of it, without copying
+
+        With MIT-SHM the view is of the shared segment, so is only valid
+        until the next grab, copy it (or use grab_bgr) to retain it
+
+        Params
+        ------
+        region : <tuple> Optional (left, top, width, height)
+
+        Returns
+        -------
+        <numpy array> (H, W, 4) BGRA view with MIT-SHM, otherwise a
+            read-only (H, W, 3) BGR array. None if the region is off screen
+
+        """
+        with trace_span("screen_grab", "capture", region=region,
+                        backend=self.backend):
+            if self.backend != "shm":
+                return self.grab_pyscreeze(region)
+
+            left, top, width, height = region if region else \
+                (0, 0) + tuple(self.size)
+            if left < 0 or top < 0 or width <= 0 or height <= 0 or \
+                    left + width > self.size[0] or \
+                    top + height > self.size[1]:
+                print("Region " + str(region) + " is not within the " +
+                      str(self.size) + " screen")
+                return None
+
+            with self._lock:
+                image = self.shm_image(width, height)
+                if not self._xext.XShmGetImage(self._disp, self._root, image,
+                                               left, top, _ALL_PLANES):
+                    print("XShmGetImage failed for region " + str(region))
+                    return None
+                self.grabs += 1
+                stride = image.contents.bytes_per_line
+                buf = (ctypes.c_ubyte * (stride * height)).from_address(
+                    self._shminfo.shmaddr)
+                return np.ndarray((height, width, 4), np.uint8, buf,
+                                  strides=(stride, 4, 1))
+
+    # -------------------------------------------------------------------------
+    def grab_pyscreeze(self, region):
+        """
+        Capture the screen, or a region of it, via pyscreeze
+
+        Params
+        ------
+        region : <tuple> Optional (left, top, width, height)
+
+        Returns
+        -------
+        <numpy array> read-only (H, W, 3) BGR
+
+        """
+        if region:
+            screen = pyscreeze.screenshot(region=tuple(region))
+        else:
+            screen = pyscreeze.screenshot()
+        self.grabs += 1
+        return pil_to_bgr(screen)
+
+    # -------------------------------------------------------------------------
+    def grab_bgr(self, region=None):
+        """
+        Capture the screen, or a region of it, as an owned BGR image
+
+        Params
+        ------
+        region : <tuple> Optional (left, top, width, height)
+
+        Returns
+        -------
+        <numpy array> (H, W, 3), read-only without MIT-SHM. None if the
+            region is off screen
+
+        """
+        if self.backend != "shm":
+            with trace_span("screen_grab", "capture", region=region,
+                            backend=self.backend):
+                return self.grab_pyscreeze(region)
+        with self._lock:
+            # Held across both, so another thread's grab can't overwrite the
+            # segment mid conversion
+            view = self.grab(region)
+            if view is None:
+                return None
+            return cv2.cvtColor(view, cv2.COLOR_BGRA2BGR)
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """
+        Release the shared memory segment and the X connection
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            if self._disp:
+                if getattr(self, "_attached", False):
+                    self._xext.XShmDetach(self._disp,
+                                          ctypes.byref(self._shminfo))
+                    self._xlib.XSync(self._disp, 0)
+                    self._attached = False
+                for image in self._images.values():
+                    # XShm images only free the struct, not the segment
+                    self._xlib.XDestroyImage(image)
+                self._images = {}
+                self._xlib.XCloseDisplay(self._disp)
+                self._disp = None
+            if getattr(self, "_x_handler", False):
+                _uninstall_x_error_handler(self._xlib)
+                self._x_handler = False
+            if self._shminfo is not None:
+                if self._shminfo.shmaddr:
+                    self._libc.shmdt(self._shminfo.shmaddr)
+                if self._shminfo.shmid >= 0 and self.backend != "shm":
+                    # Failed before it was marked for removal
+                    self._libc.shmctl(self._shminfo.shmid, _IPC_RMID, None)
+                self._shminfo = None
+            self.backend = "pyscreeze"
+
+    # -------------------------------------------------------------------------
+    def __enter__(self):
+        return self
+
+    # -------------------------------------------------------------------------
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    # -------------------------------------------------------------------------
+    def return_data(self, attr):
+        """
+        Return the data 'attr' within the class
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        if hasattr(self, attr):
+            rtn = getattr(self, attr)
+        else:
+            print("Cannot find attribute: " + str(attr) + " to return")
+            rtn = None
+        return rtn
+
+
+# -----------------------------------------------------------------------------
+# ---- main
+if __name__ == "__main__":
+    # Polling rate of a region, through the session and through pyscreeze.
+    # Headlessly: xvfb-run -s "-screen 0 1920x1080x24" python screen_session.py
+    region = (100, 100, 400, 120)
+    n_grabs = 50
+
+    with ScreenSession() as session:
+        print("Backend: " + session.backend + ", screen " +
+              str(session.size))
+        for name, grab in (
+                ("session", lambda: session.grab_bgr(region)),
+                ("pyscreeze", lambda: pil_to_bgr(
+                    pyscreeze.screenshot(region=region)))):
+            try:
+                start = time.perf_counter()
+                for _ in range(n_grabs):
+                    frame = grab()
+                elapsed = time.perf_counter() - start
+                print(name + ": " + str(round(n_grabs / elapsed, 1)) +
+                      " grabs/s, " + str(frame.shape))
+            except Exception as err:
+                print(name + " unavailable: " + str(err))
+
+        if session.backend == "shm":
+            reference = pil_to_bgr(pyscreeze.screenshot(region=region))
+            print("Matches pyscreeze: " +
+                  str(np.array_equal(session.grab_bgr(region), reference)))
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Execution tracing of gates, paths, steps, OCR calls and captures
+
+Events are written in the Chrome Trace Event format (view in chrome://tracing
+or https://ui.perfetto.dev), or as one JSON event per line when the trace file
+ends in .jsonl
+
+Enable by setting the environment variable PYOCRTOOLS_TRACE to the trace file
+path, or via enable_tracing(). When disabled, trace_span hands back a shared
+no-op context manager, so instrumented code pays only a flag check.
+
+Each process writes its own file, worker processes append their pid to the
+file stem so events never interleave mid-line. Worker files are closed by a
+multiprocessing finaliser, and when the owning process closes its trace the
+worker files are merged into it and removed, giving a single timeline.
+Worker files left unterminated (e.g. by Pool.terminate) are merged up to their
+last complete event.
+"""
+
+from multiprocessing import util as mp_util
+from pathlib import Path
+
+import atexit
+import json
+import os
+import re
+import threading
+import time
+
+
+TRACE_ENV = "PYOCRTOOLS_TRACE"
+TRACE_OWNER_ENV = "PYOCRTOOLS_TRACE_OWNER"
+
+
+# -----------------------------------------------------------------------------
+class _NullSpan:
+    """
+    No-op context manager handed out when tracing is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+# -----------------------------------------------------------------------------
+class _Span:
+    """
+    Context manager emitting a begin/end event pair
+    """
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.tracer.event("B", self.name, self.cat, self.args)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.event("E", self.name, self.cat)
+        return False
+
+
+# -----------------------------------------------------------------------------
+class Tracer:
+    """
+    Class for writing trace events to file
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, **kwargs):
+        """
+        Instantiate the class
+
+        Params
+        ------
+        kwargs : <dict>
+            file_path : <str> trace file, tracing is disabled if None
+            trace_format : <str> "chrome" or "jsonl", by default taken from
+                the file suffix
+
+        Returns
+        -------
+        None
+
+        """
+        self.file_path = None
+        self.trace_format = None
+
+        # This will set all entries within kwargs into the class variable space
+        for key_val in kwargs.items():
+            setattr(self, key_val[0], key_val[1])
+
+        if self.file_path and not self.trace_format:
+            self.trace_format = \
+                "jsonl" if str(self.file_path).endswith(".jsonl") else "chrome"
+
+        self.enabled = bool(self.file_path)
+        if self.enabled and TRACE_OWNER_ENV not in os.environ:
+            # Workers inherit this, so know to write to their own file
+            os.environ[TRACE_OWNER_ENV] = str(os.getpid())
+        self._lock = threading.Lock()
+        self._handle = None
+        self._pid = None
+        self._opened_ns = None
+
+    # -------------------------------------------------------------------------
+    def event(self, phase, name, cat, args=None):
+        """
+        Write a single event
+
+        Params
+        ------
+        phase : <str> Chrome trace phase, "B" begin or "E" end
+        name : <str> event name
+        cat : <str> event category, e.g. gate, path, step, ocr, capture
+        args : <dict> Optional event arguments
+
+        Returns
+        -------
+        None
+
+        """
+        record = {"name": name,
+                  "cat": cat,
+                  "ph": phase,
+                  "ts": time.perf_counter_ns() / 1000,
+                  "pid": os.getpid(),
+                  "tid": threading.get_ident(),
+                  }
+        if args:
+            record["args"] = args
+
+        line = json.dumps(record, default=str)
+        with self._lock:
+            handle = self.file_handle()
+            if self.trace_format == "jsonl":
+                handle.write(line + "\n")
+            else:
+                # Chrome tolerates the trailing comma of an unterminated array
+                # should the process die before close
+                handle.write(line + ",\n")
+
+    # -------------------------------------------------------------------------
+    def file_handle(self):
+        """
+        Open the trace file for this process on first use
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <file>
+
+        """
+        pid = os.getpid()
+        if self._handle is None or self._pid != pid:
+            file_path = Path(self.file_path)
+            if os.environ.get(TRACE_OWNER_ENV) != str(pid):
+                # Worker process, write alongside the owner's trace. Pool
+                # workers leave via os._exit, skipping atexit, but do run
+                # multiprocessing's finalisers
+                file_path = file_path.with_name(
+                    file_path.stem + "." + str(pid) + file_path.suffix)
+                mp_util.Finalize(self, self.close, exitpriority=10)
+            self._opened_ns = time.time_ns()
+            self._handle = open(file_path, "w", buffering=1)
+            self._pid = pid
+            if self.trace_format != "jsonl":
+                self._handle.write("[\n")
+        return self._handle
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """
+        Terminate and close the trace file
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        None
+
+        """
+        with self._lock:
+            if self._handle is not None and self._pid == os.getpid():
+                pids = [self._pid]
+                if os.environ.get(TRACE_OWNER_ENV) == str(self._pid):
+                    pids += self.merge_workers()
+                if self.trace_format != "jsonl":
+                    # Metadata events close the array cleanly
+                    self._handle.write(",\n".join(
+                        json.dumps({"name": "process_name", "ph": "M",
+                                    "pid": pid,
+                                    "args": {"name": "pyOCRtools"}})
+                        for pid in pids) + "\n]\n")
+                self._handle.close()
+            self._handle = None
+
+    # -------------------------------------------------------------------------
+    def merge_workers(self):
+        """
+        Append the events of the worker trace files written during this trace
+        to the owner's, removing the worker files
+
+        Params
+        ------
+        None
+
+        Returns
+        -------
+        <list> of the worker pids merged
+
+        """
+        file_path = Path(self.file_path)
+        worker_name = re.compile(re.escape(file_path.stem) + r"\.(\d+)" +
+                                 re.escape(file_path.suffix) + "$")
+        pids = []
+        for worker_file in sorted(file_path.parent.iterdir()):
+            match = worker_name.match(worker_file.name)
+            if match is None or int(match.group(1)) == self._pid:
+                continue
+            try:
+                if worker_file.stat().st_mtime_ns < self._opened_ns:
+                    continue  # Left over from an earlier trace
+                with open(worker_file, "r") as f:
+                    lines = f.readlines()
+            except OSError as err:
+                print("Unable to merge trace file: " + str(worker_file) +
+                      ", " + str(err))
+                continue
+
+            for line in lines:
+                line = line.strip().rstrip(",")
+                if line in ("", "[", "]"):
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Torn final event
+                if record.get("ph") == "M":
+                    continue
+                if self.trace_format == "jsonl":
+                    self._handle.write(line + "\n")
+                else:
+                    self._handle.write(line + ",\n")
+            pids.append(int(match.group(1)))
+            try:
+                worker_file.unlink()
+            except OSError:
+                pass
+        return pids
+
+
+TRACER = Tracer(**{"file_path": os.environ.get(TRACE_ENV)})
+
+
+# -----------------------------------------------------------------------------
+def trace_span(name, cat, **args):
+    """
+    Context manager tracing a begin/end pair around a block
+
+    Params
+    ------
+    name : <str> event name
+    cat : <str> event category
+    args : Optional event arguments
+
+    Returns
+    -------
+    context manager
+
+    """
+    if not TRACER.enabled:
+        return _NULL_SPAN
+    return _Span(TRACER, name, cat, args)
+
+
+# -----------------------------------------------------------------------------
+def enable_tracing(file_path, trace_format=None):
+    """
+    Enable tracing to file, replacing any existing trace
+
+    Params
+    ------
+    file_path : <str> trace file, .jsonl for JSON lines, otherwise Chrome
+    trace_format : <str> Optional "chrome" or "jsonl" override
+
+    Returns
+    -------
+    None
+
+    """
+    global TRACER
+    TRACER.close()
+    os.environ[TRACE_OWNER_ENV] = str(os.getpid())
+    TRACER = Tracer(**{"file_path": file_path,
+                       "trace_format": trace_format})
+    os.environ[TRACE_ENV] = str(file_path)  # Inherited by worker processes
+
+
+# -----------------------------------------------------------------------------
+def disable_tracing():
+    """
+    Disable tracing, closing any open trace file
+
+    Params
+    ------
+    None
+
+    Returns
+    -------
+    None
+
+    """
+    global TRACER
+    TRACER.close()
+    TRACER = Tracer()
+    os.environ.pop(TRACE_ENV, None)
+    os.environ.pop(TRACE_OWNER_ENV, None)
+
+
+atexit.register(lambda: TRACER.close())